@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+# bench.py
+# Replay benchmark for the ff.py handlers.
+# Pushes synthetic or recorded Update streams through the real Application
+# (handlers, update processor, job queue, SQLite) while a fake Bot API
+# transport answers every outbound call, records it and optionally sleeps to
+# mimic network latency.
+# Run:
+#   python bench.py                                  (all workloads, JSON on stdout)
+#   python bench.py --workload spam --latency 0.05
+#   python bench.py --replay updates.jsonl --admins 111,222
+#   python bench.py --out new.json --baseline old.json --max-regression 0.2
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+WORKLOADS = ("chatter", "spam", "crosspost", "links", "media", "joins", "raid", "admin", "mixed")
+BOT_ID = 42
+TOKEN = "42:bench"
+CHAT_BASE = -1001000000000
+
+# ----------------- Fake Bot API -----------------
+def _user(uid: int) -> Dict[str, Any]:
+    return {"id": uid, "is_bot": False, "first_name": f"User{uid}", "username": f"user{uid}"}
+
+def _chat(cid: int) -> Dict[str, Any]:
+    return {"id": cid, "type": "supergroup", "title": f"Group {cid}"}
+
+def make_request_class():
+    from telegram.request import BaseRequest
+
+    class FakeRequest(BaseRequest):
+        def __init__(self, latency: float, admins: List[int]):
+            self.latency = latency
+            self.admins = admins
+            self.calls: Counter = Counter()
+            self._next_id = 10 ** 7
+
+        async def initialize(self) -> None:
+            pass
+
+        async def shutdown(self) -> None:
+            pass
+
+        async def do_request(self, url, method, request_data=None, **timeouts) -> Tuple[int, bytes]:
+            endpoint = url.rsplit("/", 1)[-1]
+            self.calls[endpoint] += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            params = request_data.parameters if request_data else {}
+            body = {"ok": True, "result": self._result(endpoint, params)}
+            return 200, json.dumps(body).encode()
+
+        def _result(self, endpoint: str, params: Dict[str, Any]) -> Any:
+            if endpoint == "getMe":
+                return {"id": BOT_ID, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+            if endpoint in ("sendMessage", "editMessageText"):
+                self._next_id += 1
+                return {
+                    "message_id": params.get("message_id", self._next_id),
+                    "date": int(time.time()),
+                    "chat": _chat(int(params.get("chat_id", 0))),
+                    "text": params.get("text", ""),
+                }
+            if endpoint == "getChatAdministrators":
+                return [{"status": "creator", "user": _user(uid), "is_anonymous": False} for uid in self.admins]
+            if endpoint == "getChatMemberCount":
+                return 1000
+            if endpoint == "getChatMember":
+                return {"status": "member", "user": _user(int(params.get("user_id", 0)))}
+            return True
+
+    return FakeRequest
+
+# ----------------- Workloads -----------------
+class UpdateFactory:
+    def __init__(self, chats: int, users: int, admins: List[int], seed: int):
+        self.rng = random.Random(seed)
+        self.chats = [CHAT_BASE - i for i in range(chats)]
+        self.users = list(range(1000, 1000 + users))
+        self.admins = admins
+        self._update_id = 0
+        self._message_id: Counter = Counter()
+
+    def _message(self, chat_id: int, user_id: int, **fields) -> Dict[str, Any]:
+        self._update_id += 1
+        self._message_id[chat_id] += 1
+        message = {
+            "message_id": self._message_id[chat_id],
+            "date": int(time.time()),
+            "chat": _chat(chat_id),
+            "from": _user(user_id),
+        }
+        message.update(fields)
+        return {"update_id": self._update_id, "message": message}
+
+    def text(self, chat_id: int, user_id: int, text: str, entities: Optional[list] = None) -> Dict[str, Any]:
+        fields: Dict[str, Any] = {"text": text}
+        if entities:
+            fields["entities"] = entities
+        return self._message(chat_id, user_id, **fields)
+
+    def command(self, chat_id: int, user_id: int, command: str, reply_to: Optional[int] = None) -> Dict[str, Any]:
+        name = command.split()[0]
+        fields: Dict[str, Any] = {
+            "text": command,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(name)}],
+        }
+        if reply_to is not None:
+            fields["reply_to_message"] = {
+                "message_id": self._message_id[chat_id],
+                "date": int(time.time()),
+                "chat": _chat(chat_id),
+                "from": _user(reply_to),
+                "text": "target",
+            }
+        return self._message(chat_id, user_id, **fields)
+
+    def join(self, chat_id: int, users: List[int]) -> Dict[str, Any]:
+        return self._message(chat_id, users[0], new_chat_members=[_user(u) for u in users])
+
+    def chatter(self) -> Dict[str, Any]:
+        return self.text(self.rng.choice(self.chats), self.rng.choice(self.users), f"hello {self._update_id}")
+
+    def link(self) -> Dict[str, Any]:
+        url = self.rng.choice(("t.me/joinchat/x", "https://example.com/a", "https://spam.biz/b"))
+        text = f"look {url} now"
+        entities = [{"type": "url", "offset": 5, "length": len(url)}]
+        return self.text(self.rng.choice(self.chats), self.rng.choice(self.users), text, entities)
+
+    def media(self) -> Dict[str, Any]:
+        # a sticker, a captioned photo or a forward
+        chat_id, user_id = self.rng.choice(self.chats), self.rng.choice(self.users)
+        file = {"file_id": f"f{self._update_id}", "file_unique_id": f"u{self._update_id}", "width": 512, "height": 512}
+        kind = self.rng.choice(("sticker", "photo", "forward"))
+        if kind == "sticker":
+            return self._message(chat_id, user_id, sticker=dict(file, type="regular", is_animated=False, is_video=False))
+        if kind == "photo":
+            return self._message(chat_id, user_id, photo=[file], caption="look at this")
+        origin = {"type": "user", "date": int(time.time()), "sender_user": _user(self.rng.choice(self.users))}
+        return self._message(chat_id, user_id, text="forwarded", forward_origin=origin)
+
+    def admin(self) -> Dict[str, Any]:
+        chat_id = self.rng.choice(self.chats)
+        admin = self.rng.choice(self.admins)
+        target = self.rng.choice(self.users)
+        command = self.rng.choice(
+            ("/warn", "/warnings", f"/warnings @user{target}", "/settings", "/rules", "/antilink on", "/slowmode 0")
+        )
+        reply_to = target if command in ("/warn", "/warnings") else None
+        return self.command(chat_id, admin, command, reply_to)
+
+    def workload(self, name: str, n: int) -> Iterator[Dict[str, Any]]:
+        if name == "chatter":
+            for _ in range(n):
+                yield self.chatter()
+        elif name == "spam":
+            # a few users each fire a burst of 20 messages into one chat
+            while n > 0:
+                chat_id, user_id = self.rng.choice(self.chats), self.rng.choice(self.users)
+                for _ in range(min(20, n)):
+                    yield self.text(chat_id, user_id, "BUY NOW")
+                n -= 20
+        elif name == "crosspost":
+            # rotating accounts paste a few long payloads across chats, amid chatter
+            payloads = [f"Earn 500 USDT a day, message me now for the secret method #{i}" for i in range(5)]
+            for _ in range(n):
+                if self.rng.random() < 0.3:
+                    yield self.text(self.rng.choice(self.chats), self.rng.choice(self.users), self.rng.choice(payloads))
+                else:
+                    yield self.chatter()
+        elif name == "links":
+            for _ in range(n):
+                yield self.link()
+        elif name == "media":
+            # non-text messages amid chatter; stickers and forwards are locked
+            for _ in range(n):
+                yield self.media() if self.rng.random() < 0.5 else self.chatter()
+        elif name == "joins":
+            # invite waves of 1-5 accounts per service message
+            for i in range(n):
+                count = self.rng.randint(1, 5)
+                first = 10 ** 6 + i * 5
+                yield self.join(self.rng.choice(self.chats), list(range(first, first + count)))
+        elif name == "raid":
+            # one account per service message, all into the same chat
+            chat_id = self.chats[0]
+            for i in range(n):
+                yield self.join(chat_id, [2 * 10 ** 6 + i])
+        elif name == "admin":
+            for _ in range(n):
+                yield self.admin()
+        elif name == "mixed":
+            for _ in range(n):
+                roll = self.rng.random()
+                if roll < 0.80:
+                    yield self.chatter()
+                elif roll < 0.90:
+                    yield self.link()
+                elif roll < 0.95:
+                    yield self.join(self.rng.choice(self.chats), [10 ** 6 + self._update_id])
+                else:
+                    yield self.admin()
+        else:
+            raise ValueError(f"unknown workload {name}")
+
+# ----------------- Runner -----------------
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+async def _prepare_chats(ff, name: str, chats: List[int]) -> None:
+    for chat_id in chats:
+        if name in ("links", "mixed"):
+            await ff.set_chat_field(chat_id, "anti_link", 1)
+        if name == "crosspost":
+            await ff.set_chat_field(chat_id, "dup_guard", 1)
+        if name == "media":
+            await ff.set_chat_field(chat_id, "locks", "sticker forward")
+        if name in ("joins", "raid", "mixed"):
+            await ff.set_chat_field(chat_id, "welcome_window", 0)
+        if name == "raid":
+            await ff.set_chat_fields(chat_id, {"raid_threshold": 20, "raid_window": 60})
+
+async def run_workload(name: str, raw_updates: List[Dict[str, Any]], chats: List[int], args) -> Dict[str, Any]:
+    import ff
+    from telegram import Update
+    from telegram.ext import ApplicationBuilder
+
+    ff.WELCOME_MIN_INTERVAL = 0  # let welcome batches flush while the run drains
+    # the fake API has no rate limits; keep the outbox from pacing the run
+    ff.outbox.rate = ff.outbox.chat_rate = ff.outbox.chat_burst = 10 ** 6
+    FakeRequest = make_request_class()
+    request = FakeRequest(args.latency, args.admins)
+    builder = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .request(request)
+        .get_updates_request(FakeRequest(0, args.admins))
+    )
+    app = ff.build_app(builder)
+    await app.initialize()
+    await app.start()
+    await _prepare_chats(ff, name, chats)
+    updates = [Update.de_json(u, app.bot) for u in raw_updates]
+
+    latencies: List[float] = []
+
+    async def timed(update) -> None:
+        t0 = time.perf_counter()
+        await app.process_update(update)
+        latencies.append(time.perf_counter() - t0)
+
+    queries0 = ff.db.queries
+    calls0 = Counter(request.calls)
+    if args.tracemalloc:
+        tracemalloc.start()
+    t0 = time.perf_counter()
+    await asyncio.gather(*(app.update_processor.process_update(u, timed(u)) for u in updates))
+    elapsed = time.perf_counter() - t0
+    # wait for queued welcome flushes and lockdown restricts so their calls are counted
+    deadline = time.monotonic() + 30
+    pending_jobs = ("welcome_flush_job", "raid_restrict_job")
+    while time.monotonic() < deadline and any(j.name in pending_jobs for j in app.job_queue.jobs()):
+        await asyncio.sleep(0.05)
+    await app.stop()  # also waits for jobs that are still running
+    await app.post_stop(app)  # drains the outbox
+    traced_peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+    if args.tracemalloc:
+        tracemalloc.stop()
+
+    calls = request.calls - calls0
+    result = {
+        "workload": name,
+        "updates": len(updates),
+        "seconds": round(elapsed, 4),
+        "throughput": round(len(updates) / elapsed, 1) if elapsed else None,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50) * 1000, 3),
+            "p99": round(percentile(latencies, 0.99) * 1000, 3),
+            "max": round(max(latencies, default=0) * 1000, 3),
+        },
+        "db_queries": ff.db.queries - queries0,
+        "api_calls": dict(sorted(calls.items())),
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "peak_traced_kb": traced_peak // 1024 if traced_peak is not None else None,
+        "config": {"chats": args.chats, "users": args.users, "latency": args.latency, "seed": args.seed},
+    }
+    await app.shutdown()
+    await app.post_shutdown(app)
+    return result
+
+def run_single(name: str, args) -> Dict[str, Any]:
+    # each workload runs in a fresh process with its own database, so caches
+    # and peak memory are not shared between workloads
+    os.environ["DB_FILE"] = os.path.join(tempfile.mkdtemp(prefix="ffbench-"), "bench.db")
+    import ff
+    logging.getLogger().setLevel(logging.WARNING)
+    ff.init_db()
+    factory = UpdateFactory(args.chats, args.users, args.admins, args.seed)
+    if args.replay:
+        with open(args.replay, encoding="utf-8") as fh:
+            raw = [json.loads(line) for line in fh if line.strip()]
+        chats = sorted({u["message"]["chat"]["id"] for u in raw if "message" in u})
+    else:
+        raw = list(factory.workload(name, args.updates))
+        chats = factory.chats
+    return asyncio.run(run_workload(name, raw, chats, args))
+
+def run_all(args) -> List[Dict[str, Any]]:
+    results = []
+    for name in WORKLOADS:
+        cmd = [
+            sys.executable, os.path.abspath(__file__), "--workload", name,
+            "--updates", str(args.updates), "--chats", str(args.chats), "--users", str(args.users),
+            "--latency", str(args.latency), "--seed", str(args.seed),
+            "--admins", ",".join(map(str, args.admins)),
+        ]
+        if args.tracemalloc:
+            cmd.append("--tracemalloc")
+        out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+        results.extend(json.loads(out)["results"])
+    return results
+
+def compare(results: List[Dict[str, Any]], baseline_file: str, max_regression: float) -> bool:
+    with open(baseline_file, encoding="utf-8") as fh:
+        baseline = {r["workload"]: r for r in json.load(fh)["results"]}
+    ok = True
+    for r in results:
+        old = baseline.get(r["workload"])
+        if not old:
+            continue
+        tput = (r["throughput"] - old["throughput"]) / old["throughput"]
+        p99_old = old["latency_ms"]["p99"] or 1e-9
+        p99 = (r["latency_ms"]["p99"] - p99_old) / p99_old
+        flag = ""
+        if tput < -max_regression or p99 > max_regression:
+            flag = "  REGRESSION"
+            ok = False
+        print(
+            f"{r['workload']:<8} throughput {r['throughput']:>9.1f}/s ({tput:+.1%})  "
+            f"p99 {r['latency_ms']['p99']:>8.3f} ms ({p99:+.1%})  "
+            f"db {old['db_queries']} -> {r['db_queries']}{flag}",
+            file=sys.stderr,
+        )
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput/latency benchmark for the ff.py handlers")
+    parser.add_argument("--workload", choices=WORKLOADS + ("all",), default="all")
+    parser.add_argument("--replay", help="JSONL file of recorded Update payloads (one per line)")
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--admins", default="1,2,3", help="comma-separated admin user ids")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every Bot API call")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--tracemalloc", action="store_true", help="also report traced peak memory (slower)")
+    parser.add_argument("--out", help="write JSON results to this file")
+    parser.add_argument("--baseline", help="previous --out file to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    args = parser.parse_args()
+    args.admins = [int(a) for a in args.admins.split(",") if a]
+
+    if args.replay:
+        results = [run_single("replay", args)]
+    elif args.workload == "all":
+        results = run_all(args)
+    else:
+        results = [run_single(args.workload, args)]
+
+    report = json.dumps({"results": results}, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as fh:
+            fh.write(report + "\n")
+    else:
+        print(report)
+    if args.baseline and not compare(results, args.baseline, args.max_regression):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
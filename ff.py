@@ -2,128 +2,1544 @@
 # rose_full_manager.py
 # Rose-like Telegram Group Manager Bot (full assembled)
 # Requirements:
-#   pip install python-telegram-bot==20.4
+#   pip install "python-telegram-bot[job-queue,webhooks]==20.8"
 # Run:
-#   python rose_full_manager.py
-
+#   python rose_full_manager.py                   (long polling)
+#   python rose_full_manager.py --mode webhook    (or BOT_MODE=webhook; see WEBHOOK_* below)
+
+import argparse
+import asyncio
+import heapq
+import hmac
+import itertools
+import html
+import json
 import logging
 import sqlite3
 import re
+import signal
+import string
+import sys
+import tempfile
 import time
-from functools import wraps
-from typing import Callable, Dict, Any, Optional
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from functools import lru_cache, wraps
+from typing import Callable, Dict, Any, List, Optional, Set, Tuple
+from urllib.parse import urlsplit
 
 from telegram import (
     Update,
+    Chat,
     ChatPermissions,
     ChatMember,
+    MessageEntity,
     User,
 )
 from telegram.constants import ParseMode, ChatType
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     ApplicationBuilder,
+    BaseUpdateProcessor,
+    ChatMemberHandler,
     CommandHandler,
     MessageHandler,
     ContextTypes,
     filters,
 )
+from tornado.httpserver import HTTPServer
+from tornado.web import Application as WebApplication, RequestHandler
 import os
 
 # ------------- CONFIG -------------
 BOT_TOKEN = os.getenv("BOT_TOKEN")  # Read from environment
-DB_FILE = "group_mgr.db"
+DB_FILE = os.getenv("DB_FILE", "group_mgr.db")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # public base URL; unset = don't call setWebhook (local testing)
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # checked against X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # Telegram allows 1-100
+SUDO_USERS = {int(x) for x in os.getenv("SUDO_USERS", "").replace(",", " ").split()}  # may run /gban etc.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # Prometheus /metrics; 0 = instrumentation off
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
 DEFAULT_WARN_LIMIT = 3
 DEFAULT_WELCOME = "👋 <b>Welcome {mention}!</b>"
 DEFAULT_GOODBYE = "👋 <b>Goodbye {mention}!</b>"
 SPAM_THRESHOLD = 5
 SPAM_WINDOW = 6  # seconds
+SPAM_MUTE = 300  # seconds
+DEFAULT_LINK_BLOCK = ("t.me", "telegram.me")  # always blocked when anti-link is on
+WELCOME_WINDOW = 5  # seconds joins are collected before one combined welcome
+WELCOME_MIN_INTERVAL = 15  # min seconds between welcome messages in a chat
+WELCOME_MAX_MENTIONS = 20  # users named in one welcome, the rest are counted
+RAID_WINDOW = 60  # seconds joins are counted over
+RAID_COOLDOWN = 600  # seconds a raid lockdown lasts
+RAID_RESTRICT_DELAY = 1  # seconds joiners are collected before a bulk restrict
+RAID_IDLE = 3600  # seconds without joins before a chat's counter is dropped
+FILTER_MAX = 500  # filters per chat
+FILTER_MAX_LEN = 100  # characters per phrase
+FILTER_MUTE = 600  # seconds a "mute" filter mutes for
+DUP_WINDOW = 600  # seconds a repeated text is tracked across chats
+DUP_CHATS = 3  # distinct chats posting one text that make it spam
+DUP_USERS = 5  # or distinct senders
+DUP_MIN_LEN = 32  # letters and digits; shorter texts are too common to judge
+DUP_MAX_KEYS = 50000  # fingerprints kept
+DUP_MUTE = 3600  # seconds cross-posters are muted for
+GBAN_PAGE = 5000  # rows per query when loading, importing or exporting global bans
+GBAN_FANOUT_BATCH = 20  # chats a new global ban is sent to per tick
+GBAN_FANOUT_INTERVAL = 1  # seconds
+OUTBOX_RATE = 30  # Bot API calls per second the bot makes on its own
+OUTBOX_CHAT_RATE = 20 / 60  # messages per second per chat (Telegram allows ~20/min in groups)
+OUTBOX_CHAT_BURST = 10
+OUTBOX_MERGE_WINDOW = 3  # seconds notices of one kind are merged per chat
+OUTBOX_MAX_TRIES = 5  # attempts per call when Telegram answers RetryAfter
+OUTBOX_MAX_NAMES = 20  # users named in one merged notice, the rest are counted
+OUTBOX_DRAIN_TIMEOUT = 10  # seconds queued calls get at shutdown
+PURGE_BATCH = 100  # Bot API limit for deleteMessages
+PURGE_CONCURRENCY = 4
+PURGE_PROGRESS_INTERVAL = 2  # seconds between status message edits
+SETTINGS_CACHE_SIZE = 10000  # chats kept in memory
+ADMIN_CACHE_TTL = 600  # seconds before an admin roster is reloaded
+ADMIN_RECHECK = 30  # min seconds between forced reloads for unknown users
+FLOOD_MAX_KEYS = 200000  # hard cap on tracked (chat, user) pairs
+FLOOD_IDLE = 3600  # seconds of silence before a pair is forgotten (also caps slowmode memory)
+FLOOD_SWEEP_INTERVAL = 300  # seconds
+WARN_SWEEP_INTERVAL = 600  # seconds between expired-warning cleanups
+WARN_SWEEP_BATCH = 500  # rows deleted per transaction
+WRITE_BEHIND_MS = int(os.getenv("WRITE_BEHIND_MS", "0"))  # batch settings/warn writes this often; 0 = write through
+WRITE_BEHIND_MAX_OPS = 200  # flush early once this many writes are queued
+STATE_BACKEND = os.getenv("STATE_BACKEND", "")  # redis://[:password@]host:port/db to share state between workers
+TIMED_TICK = 1  # seconds between checks for due unmutes/unbans/unlocks
+TIMED_LOOKAHEAD = 3600  # seconds of upcoming timed actions held in memory
+TIMED_LOAD_BATCH = 5000  # rows loaded per refill
+TIMED_RUN_BATCH = 25  # actions run per tick (Bot API allows ~30 requests/s)
+TIMED_RETRY = 30  # seconds before a timed action that hit a network error is retried
+USERS_CACHE_SIZE = 100000  # profiles kept in memory for @username/id lookups
+USERS_BATCH = 500  # new or changed profiles that trigger an early write
+USERS_FLUSH = 5  # seconds between profile writes
+MODLOG_BATCH = 500  # buffered audit-log rows that trigger an early write
+MODLOG_FLUSH = 2  # seconds between audit-log writes
+MODLOG_PAGE = 15  # entries per /modlog page
+MODLOG_RETENTION = int(os.getenv("MODLOG_RETENTION_DAYS", "90"))  # days kept, 0 = forever
+MODLOG_PRUNE_INTERVAL = 3600  # seconds
+MODLOG_PRUNE_BATCH = 1000  # rows deleted per transaction (~25 ms with four indexes)
+CONCURRENT_UPDATES = 64  # chats processed at the same time
 # ----------------------------------
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 log = logging.getLogger(__name__)
-
-# in-memory trackers
-_msg_times: Dict[tuple, list] = {}  # (chat_id, user_id) -> [timestamps]
+# the job queue runs timed actions and the gban fan-out every second; APScheduler
+# would log two INFO lines per run
+logging.getLogger("apscheduler").setLevel(logging.WARNING)
+
+# ----------------- Metrics -----------------
+class _Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, buckets: int):
+        self.counts = [0] * buckets
+        self.sum = 0.0
+        self.count = 0
+
+# Counters, latency histograms and callback gauges rendered in the Prometheus
+# text format on METRICS_PORT. Nothing is wrapped or timed unless enabled.
+class Metrics:
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self._help: Dict[str, Tuple[str, str]] = {}  # name -> (type, help)
+        self._counters: Dict[str, Dict[tuple, float]] = {}
+        self._histograms: Dict[str, Dict[tuple, _Histogram]] = {}
+        self._gauges: Dict[str, Callable[[], float]] = {}
+
+    def counter(self, name: str, help_text: str) -> None:
+        self._help[name] = ("counter", help_text)
+        self._counters[name] = {}
+
+    def histogram(self, name: str, help_text: str) -> None:
+        self._help[name] = ("histogram", help_text)
+        self._histograms[name] = {}
+
+    def gauge(self, name: str, help_text: str, fn: Callable[[], float], kind: str = "gauge") -> None:
+        # a value read at scrape time; kind="counter" for running totals kept elsewhere
+        self._help[name] = (kind, help_text)
+        self._gauges[name] = fn
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1) -> None:
+        series = self._counters[name]
+        series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name: str, labels: tuple, seconds: float) -> None:
+        series = self._histograms[name]
+        h = series.get(labels)
+        if h is None:
+            h = series[labels] = _Histogram(len(self.BUCKETS))
+        h.count += 1
+        h.sum += seconds
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                h.counts[i] += 1
+                break
+
+    @staticmethod
+    def _labels(labels: tuple, extra: str = "") -> str:
+        parts = [f'{k}="{v}"' for k, v in labels]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        lines = []
+        for name, (kind, help_text) in self._help.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if name in self._gauges:
+                lines.append(f"{name} {self._gauges[name]()}")
+            elif kind == "counter":
+                for labels, value in list(self._counters[name].items()):
+                    lines.append(f"{name}{self._labels(labels)} {value}")
+            else:
+                for labels, h in list(self._histograms[name].items()):
+                    cumulative = 0
+                    for bound, n in zip(self.BUCKETS, h.counts):
+                        cumulative += n
+                        le = f'le="{bound}"'
+                        lines.append(f"{name}_bucket{self._labels(labels, le)} {cumulative}")
+                    le = 'le="+Inf"'
+                    lines.append(f"{name}_bucket{self._labels(labels, le)} {h.count}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {h.sum}")
+                    lines.append(f"{name}_count{self._labels(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics(METRICS_PORT > 0)
+metrics.histogram("ff_handler_seconds", "Handler latency by callback.")
+metrics.counter("ff_handler_errors_total", "Handler calls that raised.")
+metrics.histogram("ff_db_seconds", "SQLite time per DB helper, measured on the storage thread.")
+metrics.histogram("ff_stage_seconds", "Moderation pipeline time per stage.")
+metrics.counter("ff_bot_api_calls_total", "Outbound Bot API calls by method.")
+metrics.counter("ff_bot_api_retry_after_total", "Bot API calls answered with 429 RetryAfter.")
+
+def instrument(callback: Callable) -> Callable:
+    labels = (("handler", callback.__name__),)
+
+    @wraps(callback)
+    async def timed(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        t0 = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            metrics.inc("ff_handler_errors_total", labels)
+            raise
+        finally:
+            metrics.observe("ff_handler_seconds", labels, time.perf_counter() - t0)
+    return timed
+
+# Counts Bot API calls by method, including the ones Telegram throttles.
+class MetricsRequest(HTTPXRequest):
+    async def do_request(self, url: str, method: str, request_data=None, **kwargs) -> Tuple[int, bytes]:
+        code, payload = await super().do_request(url, method, request_data, **kwargs)
+        labels = (("method", url.rsplit("/", 1)[-1]),)
+        metrics.inc("ff_bot_api_calls_total", labels)
+        if code == 429:
+            metrics.inc("ff_bot_api_retry_after_total", labels)
+        return code, payload
+
+class MetricsHandler(RequestHandler):
+    def get(self) -> None:
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(metrics.render())
+
+# ----------------- Flood tracking -----------------
+FLOOD_OK, FLOOD_SLOW, FLOOD_SPAM = 0, 1, 2
+
+# Token bucket per (chat_id, user_id): constant memory and an O(1) check. The
+# bucket drives anti-spam; `last` (time of the last accepted message) drives
+# slowmode, so the two policies no longer share state.
+class _Bucket:
+    __slots__ = ("tokens", "stamp", "last")
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.stamp = now
+        self.last = float("-inf")
+
+# Keys live in LRU order, so the hard cap and the idle sweep both evict from
+# the front without scanning.
+class FloodTracker:
+    def __init__(self, max_keys: int, idle: float):
+        self.max_keys = max_keys
+        self.idle = idle
+        self._data: "OrderedDict[tuple, _Bucket]" = OrderedDict()
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def check(self, key: tuple, now: float, limit: int, window: int, burst: int, slow_mode: int) -> int:
+        # limit messages per window seconds with up to burst in a row (0 = limit);
+        # limit 0 turns anti-spam off. Spam wins over slowmode.
+        capacity = burst or limit
+        b = self._data.get(key)
+        if b is None:
+            b = self._data[key] = _Bucket(capacity, now)
+            if len(self._data) > self.max_keys:
+                self._data.popitem(last=False)
+                self.evictions += 1
+        else:
+            self._data.move_to_end(key)
+        if limit > 0:
+            b.tokens = min(capacity, b.tokens + (now - b.stamp) * limit / window)
+            b.stamp = now
+            if b.tokens < 1:
+                return FLOOD_SPAM
+            b.tokens -= 1
+        else:
+            b.stamp = now
+        if slow_mode > 0 and now - b.last < slow_mode:
+            return FLOOD_SLOW
+        b.last = now
+        return FLOOD_OK
+
+    def sweep(self, now: float) -> int:
+        removed = 0
+        while self._data:
+            key, b = next(iter(self._data.items()))
+            if now - b.stamp < self.idle:
+                break
+            del self._data[key]
+            removed += 1
+        return removed
+
+    def stats(self) -> Dict[str, int]:
+        mem = sys.getsizeof(self._data) + sum(
+            sys.getsizeof(k) + sys.getsizeof(b) for k, b in self._data.items()
+        )
+        return {"keys": len(self._data), "max_keys": self.max_keys, "evictions": self.evictions, "bytes": mem}
+
+flood = FloodTracker(FLOOD_MAX_KEYS, FLOOD_IDLE)
+
+async def flood_sweep_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    removed = flood.sweep(time.monotonic())
+    if removed:
+        log.info("Flood tracker: swept %d idle keys, %d left", removed, len(flood))
+
+# ----------------- Storage -----------------
+# One long-lived SQLite connection served by a single worker thread: every query
+# runs there, so the event loop never waits on disk and the connection is never
+# shared between threads. Handlers await Storage.run().
+#
+# With write-behind enabled, Storage.write() only queues a mutation; queued
+# mutations are committed together in one transaction by the flush job, when
+# max_ops pile up, at close(), or ahead of the next run() -- so every read
+# still sees them.
+class Storage:
+    def __init__(self, path: str, write_behind: bool = False, max_ops: int = 200):
+        self.path = path
+        self.write_behind = write_behind
+        self.max_ops = max_ops
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._pending: List[Tuple[Callable, tuple]] = []
+        self.queries = 0
+        self.batches = 0
+        self.batched_ops = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn = conn
+        return self._conn
+
+    def _apply(self, ops: List[Tuple[Callable, tuple]], helper: str = "write_behind") -> None:
+        conn = self._connection()
+        t0 = time.perf_counter()
+        try:
+            with conn:
+                for fn, args in ops:
+                    fn(conn, *args)
+        except Exception:
+            # don't let one bad mutation take the rest of the batch with it
+            log.exception("Write-behind batch failed, retrying %d ops one by one", len(ops))
+            for fn, args in ops:
+                try:
+                    with conn:
+                        fn(conn, *args)
+                except Exception:
+                    log.exception("Dropped write %s%r", fn.__name__, args)
+        self.batches += 1
+        self.batched_ops += len(ops)
+        if metrics.enabled:
+            metrics.observe("ff_db_seconds", (("helper", helper),), time.perf_counter() - t0)
+
+    def _call(self, fn: Callable, args: tuple, pending: Optional[List[Tuple[Callable, tuple]]] = None) -> Any:
+        if pending:
+            self._apply(pending)
+        conn = self._connection()
+        if not metrics.enabled:
+            with conn:  # commit on success, roll back on error
+                return fn(conn, *args)
+        t0 = time.perf_counter()
+        try:
+            with conn:
+                return fn(conn, *args)
+        finally:
+            metrics.observe("ff_db_seconds", (("helper", fn.__name__.removeprefix("_q_")),), time.perf_counter() - t0)
+
+    def _drain(self) -> List[Tuple[Callable, tuple]]:
+        pending, self._pending = self._pending, []
+        return pending
+
+    async def run(self, fn: Callable, *args) -> Any:
+        self.queries += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, fn, args, self._drain())
+
+    async def write(self, fn: Callable, *args) -> None:
+        if not self.write_behind:
+            await self.run(fn, *args)
+            return
+        self._pending.append((fn, args))
+        if len(self._pending) >= self.max_ops:
+            self.flush_nowait()
+
+    def submit(self, fn: Callable, *args) -> None:
+        # a write nobody waits for: it commits after everything queued before
+        # it, and a failure is logged rather than raised
+        self.flush_nowait()  # queued write-behind ops keep their own batch and label
+        self._executor.submit(self._apply, [(fn, args)], fn.__name__.removeprefix("_q_"))
+
+    def flush_nowait(self) -> None:
+        # the executor is FIFO, so later run() calls still queue behind this
+        if self._pending:
+            self._executor.submit(self._apply, self._drain())
+
+    async def flush(self) -> None:
+        if self._pending:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._executor, self._apply, self._drain())
+
+    def run_sync(self, fn: Callable, *args) -> Any:
+        # for startup/shutdown code that runs outside the event loop
+        return self._executor.submit(self._call, fn, args, self._drain()).result()
+
+    def close(self) -> None:
+        def _close() -> None:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        pending = self._drain()
+        if pending:
+            self._executor.submit(self._apply, pending).result()
+        self._executor.submit(_close).result()
+        self._executor.shutdown(wait=True)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queries": self.queries,
+            "pending": len(self._pending),
+            "batches": self.batches,
+            "batched_ops": self.batched_ops,
+        }
+
+async def write_behind_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    db.flush_nowait()
+
+db = Storage(DB_FILE, WRITE_BEHIND_MS > 0, WRITE_BEHIND_MAX_OPS)
 
 # ----------------- DB helpers -----------------
-def init_db() -> None:
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute(f"""CREATE TABLE IF NOT EXISTS chats (
+# column -> SQL declaration; columns missing from an older database are added by init_db
+CHAT_COLUMNS = {
+    "rules": "TEXT DEFAULT 'No rules set.'",
+    "anti_link": "INTEGER DEFAULT 0",
+    "slow_mode": "INTEGER DEFAULT 0",
+    "warn_limit": f"INTEGER DEFAULT {DEFAULT_WARN_LIMIT}",
+    "welcome": f"TEXT DEFAULT '{DEFAULT_WELCOME}'",
+    "goodbye": f"TEXT DEFAULT '{DEFAULT_GOODBYE}'",
+    "flood_limit": f"INTEGER DEFAULT {SPAM_THRESHOLD}",
+    "flood_window": f"INTEGER DEFAULT {SPAM_WINDOW}",
+    "flood_burst": "INTEGER DEFAULT 0",
+    "flood_mute": f"INTEGER DEFAULT {SPAM_MUTE}",
+    "warn_expiry": "INTEGER DEFAULT 0",  # seconds, 0 = warnings never expire
+    "welcome_window": f"INTEGER DEFAULT {WELCOME_WINDOW}",
+    "clean_welcome": "INTEGER DEFAULT 0",
+    "link_allow": "TEXT DEFAULT ''",  # space-separated domains
+    "link_block": "TEXT DEFAULT ''",
+    "raid_threshold": "INTEGER DEFAULT 0",  # joins per raid_window that start a lockdown, 0 = off
+    "raid_window": f"INTEGER DEFAULT {RAID_WINDOW}",
+    "raid_cooldown": f"INTEGER DEFAULT {RAID_COOLDOWN}",
+    "raid_until": "INTEGER DEFAULT 0",  # unix time the current lockdown ends
+    "filter_version": "INTEGER DEFAULT 0",  # changes with the chat's filters, 0 = none ever set
+    "dup_guard": "INTEGER DEFAULT 0",  # cross-chat duplicate detection, opt-in
+    "locks": "TEXT DEFAULT ''",  # space-separated LOCK_TYPES whose messages are deleted
+}
+CHAT_FIELDS = tuple(CHAT_COLUMNS)
+_CHAT_SELECT = f"SELECT {', '.join(CHAT_FIELDS)} FROM chats WHERE chat_id=?"
+
+_CHAT_TYPES = {
+    "anti_link": bool,
+    "slow_mode": int,
+    "warn_limit": int,
+    "flood_limit": int,
+    "flood_window": int,
+    "flood_burst": int,
+    "flood_mute": int,
+    "warn_expiry": int,
+    "welcome_window": int,
+    "clean_welcome": bool,
+    "raid_threshold": int,
+    "raid_window": int,
+    "raid_cooldown": int,
+    "raid_until": int,
+    "filter_version": int,
+    "dup_guard": bool,
+}
+
+class ChatSettings:
+    __slots__ = CHAT_FIELDS + ("plan",)  # plan: the chat's moderation stages, see ModerationPipeline
+
+    def __init__(self, row: tuple):
+        self.plan = None
+        for field, value in zip(CHAT_FIELDS, row):
+            setattr(self, field, _CHAT_TYPES.get(field, str)(value))
+
+# Bounded LRU of ChatSettings. set_chat_field patches entries in place, so in
+# steady state protect_handler never touches the database.
+class SettingsCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[int, ChatSettings]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writes = 0
+
+    def get(self, chat_id: int) -> Optional[ChatSettings]:
+        s = self._data.get(chat_id)
+        if s is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._data.move_to_end(chat_id)
+        return s
+
+    def put(self, chat_id: int, s: ChatSettings) -> None:
+        self._data[chat_id] = s
+        self._data.move_to_end(chat_id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def update(self, chat_id: int, field: str, value: Any) -> None:
+        self.writes += 1
+        s = self._data.get(chat_id)
+        if s is not None:
+            setattr(s, field, _CHAT_TYPES.get(field, str)(value))
+            s.plan = None
+
+    def invalidate(self, chat_id: int) -> None:
+        self.writes += 1
+        self._data.pop(chat_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+settings_cache = SettingsCache(SETTINGS_CACHE_SIZE)
+
+def _q_init_db(conn: sqlite3.Connection) -> None:
+    columns = ",\n            ".join(f"{name} {decl}" for name, decl in CHAT_COLUMNS.items())
+    conn.execute(f"""CREATE TABLE IF NOT EXISTS chats (
             chat_id INTEGER PRIMARY KEY,
-            rules TEXT DEFAULT 'No rules set.',
-            anti_link INTEGER DEFAULT 0,
-            slow_mode INTEGER DEFAULT 0,
-            warn_limit INTEGER DEFAULT {DEFAULT_WARN_LIMIT},
-            welcome TEXT DEFAULT '{DEFAULT_WELCOME}',
-            goodbye TEXT DEFAULT '{DEFAULT_GOODBYE}'
+            {columns}
         );""")
-    c.execute("""CREATE TABLE IF NOT EXISTS warns (
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(chats)")}
+    for name, decl in CHAT_COLUMNS.items():
+        if name not in existing:
+            conn.execute(f"ALTER TABLE chats ADD COLUMN {name} {decl}")
+    conn.execute("""CREATE TABLE IF NOT EXISTS warns (
             chat_id INTEGER,
             user_id INTEGER,
             count INTEGER DEFAULT 0,
+            expires_at INTEGER,
             PRIMARY KEY (chat_id, user_id)
         );""")
-    conn.commit()
-    conn.close()
-
-def ensure_chat(chat_id: int) -> None:
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT 1 FROM chats WHERE chat_id=?", (chat_id,))
-    if not c.fetchone():
-        c.execute("INSERT INTO chats (chat_id) VALUES (?)", (chat_id,))
-        conn.commit()
-    conn.close()
-
-def get_chat(chat_id: int) -> Dict[str, Any]:
-    ensure_chat(chat_id)
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT rules, anti_link, slow_mode, warn_limit, welcome, goodbye FROM chats WHERE chat_id=?", (chat_id,))
-    row = c.fetchone()
-    conn.close()
-    return {
-        "rules": row[0],
-        "anti_link": bool(row[1]),
-        "slow_mode": int(row[2]),
-        "warn_limit": int(row[3]),
-        "welcome": row[4],
-        "goodbye": row[5],
-    }
-
-def set_chat_field(chat_id: int, field: str, value: Any) -> None:
-    if field not in ("rules", "anti_link", "slow_mode", "warn_limit", "welcome", "goodbye"):
-        return
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute(f"UPDATE chats SET {field}=? WHERE chat_id=?", (value, chat_id))
-    conn.commit()
-    conn.close()
-
-def get_warns(chat_id: int, user_id: int) -> int:
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT count FROM warns WHERE chat_id=? AND user_id=?", (chat_id, user_id))
-    row = c.fetchone()
-    conn.close()
+    if "expires_at" not in {row[1] for row in conn.execute("PRAGMA table_info(warns)")}:
+        conn.execute("ALTER TABLE warns ADD COLUMN expires_at INTEGER")
+    conn.execute("CREATE INDEX IF NOT EXISTS warns_expiry ON warns (expires_at) WHERE expires_at IS NOT NULL")
+    conn.execute("""CREATE TABLE IF NOT EXISTS timed_actions (
+            id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,  -- 0 for chat-wide actions
+            action TEXT NOT NULL,
+            due_at INTEGER NOT NULL,
+            payload TEXT,
+            UNIQUE (chat_id, user_id, action)
+        );""")
+    conn.execute("CREATE INDEX IF NOT EXISTS timed_actions_due ON timed_actions (due_at)")
+    conn.execute("""CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT
+        );""")
+    conn.execute("CREATE INDEX IF NOT EXISTS users_username ON users (username COLLATE NOCASE)")
+    conn.execute("""CREATE TABLE IF NOT EXISTS modlog (
+            id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            ts INTEGER NOT NULL,
+            actor_id INTEGER,  -- NULL for the bot's own actions
+            user_id INTEGER,
+            action TEXT NOT NULL,
+            detail TEXT
+        );""")
+    conn.execute("CREATE INDEX IF NOT EXISTS modlog_chat ON modlog (chat_id, ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS modlog_user ON modlog (user_id, ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS modlog_ts ON modlog (ts)")  # retention pruning
+    conn.execute("""CREATE TABLE IF NOT EXISTS gbans (
+            user_id INTEGER PRIMARY KEY,
+            reason TEXT,
+            banned_by INTEGER,
+            ts INTEGER
+        );""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS filters (
+            chat_id INTEGER,
+            pattern TEXT,
+            action TEXT,
+            PRIMARY KEY (chat_id, pattern)
+        );""")
+
+def _q_ensure_chat(conn: sqlite3.Connection, chat_id: int) -> None:
+    conn.execute("INSERT OR IGNORE INTO chats (chat_id) VALUES (?)", (chat_id,))
+
+def _q_get_chat(conn: sqlite3.Connection, chat_id: int) -> tuple:
+    row = conn.execute(_CHAT_SELECT, (chat_id,)).fetchone()
+    if row is None:
+        _q_ensure_chat(conn, chat_id)
+        row = conn.execute(_CHAT_SELECT, (chat_id,)).fetchone()
+    return row
+
+def _q_set_chat_fields(conn: sqlite3.Connection, chat_id: int, values: Dict[str, Any]) -> None:
+    _q_ensure_chat(conn, chat_id)
+    assignments = ", ".join(f"{field}=?" for field in values)
+    conn.execute(f"UPDATE chats SET {assignments} WHERE chat_id=?", (*values.values(), chat_id))
+
+def _q_get_warns(conn: sqlite3.Connection, chat_id: int, user_id: int, now: int) -> int:
+    row = conn.execute(
+        "SELECT count FROM warns WHERE chat_id=? AND user_id=? AND (expires_at IS NULL OR expires_at > ?)",
+        (chat_id, user_id, now),
+    ).fetchone()
     return row[0] if row else 0
 
-def set_warns(chat_id: int, user_id: int, count: int) -> None:
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
+def _q_add_warn(conn: sqlite3.Connection, chat_id: int, user_id: int, now: int, expires_at: Optional[int]) -> int:
+    # one atomic statement, so concurrent warns never lose an increment; an
+    # expired counter the sweeper has not reached yet restarts at 1
+    return conn.execute(
+        "INSERT INTO warns (chat_id, user_id, count, expires_at) VALUES (?,?,1,?) "
+        "ON CONFLICT(chat_id,user_id) DO UPDATE SET "
+        "count=CASE WHEN warns.expires_at <= ? THEN 1 ELSE warns.count + 1 END, "
+        "expires_at=excluded.expires_at "
+        "RETURNING count",
+        (chat_id, user_id, expires_at, now),
+    ).fetchone()[0]
+
+def _q_sweep_warns(conn: sqlite3.Connection, now: int, limit: int) -> int:
+    return conn.execute(
+        "DELETE FROM warns WHERE rowid IN "
+        "(SELECT rowid FROM warns WHERE expires_at <= ? LIMIT ?)",
+        (now, limit),
+    ).rowcount
+
+def _q_set_warns(conn: sqlite3.Connection, chat_id: int, user_id: int, count: int) -> None:
     if count <= 0:
-        c.execute("DELETE FROM warns WHERE chat_id=? AND user_id=?", (chat_id, user_id))
+        conn.execute("DELETE FROM warns WHERE chat_id=? AND user_id=?", (chat_id, user_id))
     else:
-        c.execute(
+        conn.execute(
             "INSERT INTO warns (chat_id, user_id, count) VALUES (?,?,?) "
             "ON CONFLICT(chat_id,user_id) DO UPDATE SET count=excluded.count",
             (chat_id, user_id, count),
         )
-    conn.commit()
-    conn.close()
+
+def init_db() -> None:
+    db.run_sync(_q_init_db)
+
+async def ensure_chat(chat_id: int) -> None:
+    await db.run(_q_ensure_chat, chat_id)
+
+async def get_chat(chat_id: int) -> ChatSettings:
+    s = settings_cache.get(chat_id)
+    if s is not None:
+        return s
+    while True:
+        # a write that lands while we are reading makes the row stale; the
+        # executor is FIFO, so simply reading again picks it up
+        stamp = settings_cache.writes
+        row = await db.run(_q_get_chat, chat_id)
+        if settings_cache.writes == stamp:
+            break
+    s = ChatSettings(row)
+    settings_cache.put(chat_id, s)
+    return s
+
+async def set_chat_field(chat_id: int, field: str, value: Any) -> None:
+    await set_chat_fields(chat_id, {field: value})
+
+async def set_chat_fields(chat_id: int, values: Dict[str, Any]) -> None:
+    values = {f: v for f, v in values.items() if f in CHAT_FIELDS}
+    if not values:
+        return
+    for field, value in values.items():
+        settings_cache.update(chat_id, field, value)
+    await db.write(_q_set_chat_fields, chat_id, values)
+    await state.settings_changed(chat_id)
+
+async def warn_sweep_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # batches keep each transaction short so handlers' queries interleave
+    now = int(time.time())
+    total = 0
+    while True:
+        removed = await db.run(_q_sweep_warns, now, WARN_SWEEP_BATCH)
+        total += removed
+        if removed < WARN_SWEEP_BATCH:
+            break
+    if total:
+        log.info("Warn sweep: removed %d expired warnings", total)
+
+async def get_warns(chat_id: int, user_id: int) -> int:
+    return await state.get_warns(chat_id, user_id)
+
+async def add_warn(chat_id: int, user_id: int, expiry: int = 0) -> int:
+    # returns the new count; expiry (seconds, 0 = never) restarts on every warn
+    return await state.add_warn(chat_id, user_id, expiry)
+
+async def set_warns(chat_id: int, user_id: int, count: int) -> None:
+    await state.set_warns(chat_id, user_id, count)
+
+# ----------------- Shared state -----------------
+# Flood counters, settings invalidation and warns go through `state`, so that
+# several workers can share them. LocalBackend keeps them in this process (the
+# flood tracker and SQLite) and is the default; STATE_BACKEND=redis://... moves
+# them to a Redis-protocol server.
+class LocalBackend:
+    name = "local"
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    async def check_flood(self, chat_id: int, user_id: int, s: ChatSettings) -> int:
+        return flood.check(
+            (chat_id, user_id), time.monotonic(), s.flood_limit, s.flood_window, s.flood_burst, s.slow_mode
+        )
+
+    async def settings_changed(self, chat_id: int) -> None:
+        pass  # settings_cache is the only copy and was patched already
+
+    async def get_warns(self, chat_id: int, user_id: int) -> int:
+        return await db.run(_q_get_warns, chat_id, user_id, int(time.time()))
+
+    async def add_warn(self, chat_id: int, user_id: int, expiry: int) -> int:
+        now = int(time.time())
+        return await db.run(_q_add_warn, chat_id, user_id, now, now + expiry if expiry else None)
+
+    async def set_warns(self, chat_id: int, user_id: int, count: int) -> None:
+        await db.write(_q_set_warns, chat_id, user_id, count)
+
+    def stats(self) -> Dict[str, int]:
+        return {}
+
+class RespError(Exception):
+    pass
+
+# Minimal RESP2 client. Every caller shares one connection and writes its
+# commands back to back; the server answers in order, so the reader task hands
+# each reply to the oldest waiting future. A batch of commands is one write and
+# one round trip.
+class RespClient:
+    def __init__(self, url: str):
+        parts = urlsplit(url)
+        self.host = parts.hostname or "localhost"
+        self.port = parts.port or 6379
+        self.password = parts.password
+        self.db = int(parts.path.lstrip("/") or 0)
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._waiters: deque = deque()
+        self._connecting: Optional[asyncio.Task] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self.round_trips = 0
+
+    @staticmethod
+    def _encode(command: tuple) -> bytes:
+        out = [b"*%d\r\n" % len(command)]
+        for arg in command:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            out.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        return b"".join(out)
+
+    async def _read_reply(self) -> Any:
+        line = await self._reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            return RespError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            n = int(rest)
+            return None if n < 0 else (await self._reader.readexactly(n + 2))[:-2]
+        if kind == b"*":
+            n = int(rest)
+            return None if n < 0 else [await self._read_reply() for _ in range(n)]
+        raise ConnectionError(f"unexpected reply {line[:32]!r}")
+
+    async def _read_loop(self) -> None:
+        try:
+            while True:
+                reply = await self._read_reply()
+                fut = self._waiters.popleft()
+                if not fut.done():
+                    fut.set_result(reply)
+        except Exception as e:
+            self._disconnect(e)
+
+    def _disconnect(self, exc: Exception) -> None:
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_exception(ConnectionError(f"state backend connection lost: {exc!r}"))
+
+    def _send(self, commands: Tuple[tuple, ...]) -> List[asyncio.Future]:
+        loop = asyncio.get_running_loop()
+        futs = [loop.create_future() for _ in commands]
+        self._waiters.extend(futs)
+        self._writer.write(b"".join(self._encode(c) for c in commands))
+        self.round_trips += 1
+        return futs
+
+    async def _connect(self) -> None:
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        self._reader_task = asyncio.create_task(self._read_loop())
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+        if setup:
+            for reply in await asyncio.gather(*self._send(tuple(setup))):
+                if isinstance(reply, RespError):
+                    self._disconnect(reply)
+                    raise reply
+
+    async def execute(self, *commands: tuple) -> List[Any]:
+        # sends all commands in one write and returns their replies in order
+        if self._writer is None:
+            if self._connecting is None or self._connecting.done():
+                self._connecting = asyncio.create_task(self._connect())
+            await asyncio.shield(self._connecting)
+        replies = await asyncio.gather(*self._send(commands))
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise reply
+        return replies
+
+    async def close(self) -> None:
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        self._disconnect(ConnectionError("closed"))
+
+# Shares state through a Redis-compatible server; every check is a single
+# pipelined round trip. Anti-spam approximates the token bucket with a
+# sliding-window count over two fixed slots (the threshold is the larger of
+# limit and burst), slowmode is a SET NX with the slowmode TTL, and warns are
+# counters whose expiry Redis applies itself.
+#
+# Settings stay in SQLite. Each change bumps a per-chat version and the flood
+# check reads it back for free, so a worker drops its cached copy of a chat
+# as soon as that chat sends another message. If the server is unreachable,
+# flood checks fall back to this worker's own tracker.
+class RedisBackend:
+    name = "redis"
+
+    def __init__(self, url: str, prefix: str = "ff:"):
+        self.client = RespClient(url)
+        self.prefix = prefix
+        self._versions: Dict[int, Optional[bytes]] = {}
+        self._down = False
+        self.fallbacks = 0
+
+    async def start(self) -> None:
+        await self.client.execute(("PING",))
+        log.info("🔗 Shared state on %s:%s/%s", self.client.host, self.client.port, self.client.db)
+
+    async def close(self) -> None:
+        await self.client.close()
+
+    def _seen_version(self, chat_id: int, version: Optional[bytes]) -> None:
+        if chat_id not in self._versions or self._versions[chat_id] != version:
+            self._versions[chat_id] = version
+            settings_cache.invalidate(chat_id)
+
+    async def check_flood(self, chat_id: int, user_id: int, s: ChatSettings) -> int:
+        p = self.prefix
+        now_ms = int(time.time() * 1000)
+        commands = [("GET", f"{p}cfg:{chat_id}")]
+        if s.flood_limit > 0:
+            window_ms = s.flood_window * 1000
+            slot = now_ms // window_ms
+            key = f"{p}flood:{chat_id}:{user_id}:"
+            commands += [
+                ("INCR", f"{key}{slot}"),
+                ("PEXPIRE", f"{key}{slot}", 2 * window_ms),
+                ("GET", f"{key}{slot - 1}"),
+            ]
+        if s.slow_mode > 0:
+            commands.append(("SET", f"{p}slow:{chat_id}:{user_id}", 1, "PX", s.slow_mode * 1000, "NX"))
+        try:
+            replies = await self.client.execute(*commands)
+        except (OSError, RespError) as e:
+            self.fallbacks += 1
+            if not self._down:
+                self._down = True
+                log.warning("State backend unavailable (%s), using local flood counters", e)
+            return await LocalBackend.check_flood(self, chat_id, user_id, s)
+        if self._down:
+            self._down = False
+            log.info("State backend reachable again")
+        self._seen_version(chat_id, replies[0])
+        if s.flood_limit > 0:
+            # the previous slot counts for the share of it still inside the window
+            current, previous = replies[1], int(replies[3] or 0)
+            weight = 1 - (now_ms % window_ms) / window_ms
+            if current + previous * weight > max(s.flood_limit, s.flood_burst):
+                return FLOOD_SPAM
+        if s.slow_mode > 0 and replies[-1] is None:
+            return FLOOD_SLOW
+        return FLOOD_OK
+
+    async def settings_changed(self, chat_id: int) -> None:
+        # other workers reload from SQLite, so the change must be committed first
+        await db.flush()
+        try:
+            (version,) = await self.client.execute(("INCR", f"{self.prefix}cfg:{chat_id}"))
+        except (OSError, RespError) as e:
+            log.warning("Could not publish settings change for chat %s: %s", chat_id, e)
+            return
+        if self._versions.get(chat_id) != str(version - 1).encode():
+            settings_cache.invalidate(chat_id)  # someone else changed it in between
+        self._versions[chat_id] = str(version).encode()
+
+    def _warn_key(self, chat_id: int, user_id: int) -> str:
+        return f"{self.prefix}warn:{chat_id}:{user_id}"
+
+    async def get_warns(self, chat_id: int, user_id: int) -> int:
+        (count,) = await self.client.execute(("GET", self._warn_key(chat_id, user_id)))
+        return int(count or 0)
+
+    async def add_warn(self, chat_id: int, user_id: int, expiry: int) -> int:
+        key = self._warn_key(chat_id, user_id)
+        count, _ = await self.client.execute(("INCR", key), ("EXPIRE", key, expiry) if expiry else ("PERSIST", key))
+        return count
+
+    async def set_warns(self, chat_id: int, user_id: int, count: int) -> None:
+        key = self._warn_key(chat_id, user_id)
+        await self.client.execute(("SET", key, count, "KEEPTTL") if count > 0 else ("DEL", key))
+
+    def stats(self) -> Dict[str, int]:
+        return {"round_trips": self.client.round_trips, "fallbacks": self.fallbacks}
+
+def make_state_backend(url: str):
+    if not url:
+        return LocalBackend()
+    scheme = urlsplit(url).scheme
+    if scheme == "redis":
+        return RedisBackend(url)
+    raise ValueError(f"Unsupported STATE_BACKEND scheme: {scheme!r}")
+
+state = make_state_backend(STATE_BACKEND)
+# ----------------- Outbound scheduler -----------------
+OUT_ENFORCE, OUT_NOTICE = 0, 1  # lower runs first
+
+# Bot API calls the bot makes on its own (deletes, restricts, bans, notices)
+# are queued here instead of awaited inline. A global token bucket keeps the
+# bot under Telegram's overall rate and a per-chat bucket keeps messages under
+# the group limit; enforcement always runs before notices. RetryAfter pauses
+# the chat for the delay Telegram asked for and the call is retried, so a
+# mute is never lost to a flood wait. Notices of one kind are merged into one
+# message per chat per merge window.
+#
+# A job is (priority, seq, chat_id, is_message, fn, args, kwargs, future, tries).
+class Outbox:
+    def __init__(self, rate: float, chat_rate: float, chat_burst: int, merge_window: float, max_tries: int, max_names: int):
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.merge_window = merge_window
+        self.max_tries = max_tries
+        self.max_names = max_names
+        self._queue: List[tuple] = []
+        self._seq = 0
+        self._tokens = float(rate)
+        self._stamp = time.monotonic()
+        self._chat_tokens: Dict[int, Tuple[float, float]] = {}  # chat_id -> (tokens, stamp)
+        self._paused: Dict[int, float] = {}  # chat_id -> end of its RetryAfter
+        self._held: Dict[int, List[tuple]] = {}  # chat_id -> jobs waiting for the chat
+        self._notices: Dict[Tuple[int, str], list] = {}  # (chat_id, template) -> [bot, names, extra]
+        self._running: Set[asyncio.Task] = set()
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.done = 0
+        self.retries = 0
+        self.failed = 0
+        self.merged = 0
+
+    def __len__(self) -> int:
+        return len(self._queue) + sum(map(len, self._held.values())) + len(self._running) + len(self._notices)
+
+    def submit(self, priority: int, chat_id: int, fn: Callable, *args, message: bool = False, **kwargs) -> asyncio.Future:
+        # returns a future for the call's result; failures are logged even if nobody awaits it
+        if self._task is None or self._task.done():
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        fut = asyncio.get_running_loop().create_future()
+        fut.add_done_callback(lambda f: self._report(f, fn, chat_id))
+        self._seq += 1
+        heapq.heappush(self._queue, (priority, self._seq, chat_id, message, fn, args, kwargs, fut, 0))
+        self._wake.set()
+        return fut
+
+    def enforce(self, chat_id: int, fn: Callable, *args, **kwargs) -> asyncio.Future:
+        return self.submit(OUT_ENFORCE, chat_id, fn, *args, **kwargs)
+
+    def send(self, bot, chat_id: int, text: str, **kwargs) -> asyncio.Future:
+        return self.submit(
+            OUT_NOTICE, chat_id, bot.send_message, chat_id, text, message=True, parse_mode=ParseMode.HTML, **kwargs
+        )
+
+    def notice(self, bot, chat_id: int, template: str, name: str) -> None:
+        # template has one {} for the names, e.g. "🤖 {} auto-muted for spamming."
+        key = (chat_id, template)
+        entry = self._notices.get(key)
+        if entry is None:
+            entry = self._notices[key] = [bot, [], 0]
+            asyncio.get_running_loop().call_later(self.merge_window, self._flush_notice, key)
+        else:
+            self.merged += 1
+        names = entry[1]
+        if name in names:
+            return
+        if len(names) < self.max_names:
+            names.append(name)
+        else:
+            entry[2] += 1
+
+    def _flush_notice(self, key: Tuple[int, str]) -> None:
+        entry = self._notices.pop(key, None)
+        if entry is None:
+            return
+        bot, names, extra = entry
+        text = ", ".join(names) + (f" and {extra} more" if extra else "")
+        self.send(bot, key[0], key[1].format(text))
+
+    def _report(self, fut: asyncio.Future, fn: Callable, chat_id: int) -> None:
+        if fut.cancelled():
+            return
+        e = fut.exception()
+        if e is None:
+            return
+        self.failed += 1
+        if isinstance(e, (BadRequest, Forbidden)):
+            # message already gone, user is an admin, bot lacks rights...
+            log.info("%s in %s failed: %s", fn.__name__, chat_id, e)
+        else:
+            log.warning("%s in %s failed: %r", fn.__name__, chat_id, e)
+
+    def _chat_wait(self, chat_id: int, message: bool, now: float) -> float:
+        # seconds until the chat accepts this job; takes a chat token if it does
+        paused = self._paused.get(chat_id)
+        if paused is not None:
+            if paused > now:
+                return paused - now
+            del self._paused[chat_id]
+        if not message:
+            return 0
+        tokens, stamp = self._chat_tokens.get(chat_id, (self.chat_burst, now))
+        tokens = min(self.chat_burst, tokens + (now - stamp) * self.chat_rate)
+        if tokens < 1:
+            self._chat_tokens[chat_id] = (tokens, now)
+            return (1 - tokens) / self.chat_rate
+        self._chat_tokens[chat_id] = (tokens - 1, now)
+        return 0
+
+    def _hold(self, job: tuple, delay: float) -> None:
+        chat_id = job[2]
+        held = self._held.get(chat_id)
+        if held is None:
+            held = self._held[chat_id] = []
+            asyncio.get_running_loop().call_later(delay, self._release, chat_id)
+        held.append(job)
+
+    def _release(self, chat_id: int) -> None:
+        for job in self._held.pop(chat_id, ()):
+            heapq.heappush(self._queue, job)
+        self._wake.set()
+
+    def _prune(self, now: float) -> None:
+        # buckets that have refilled carry no information
+        full = [c for c, (t, s) in self._chat_tokens.items() if t + (now - s) * self.chat_rate >= self.chat_burst]
+        for chat_id in full:
+            del self._chat_tokens[chat_id]
+
+    async def _run(self) -> None:
+        while True:
+            if not self._queue:
+                self._prune(time.monotonic())
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                continue
+            job = heapq.heappop(self._queue)
+            if job[7].done():
+                continue  # cancelled by the caller
+            wait = self._chat_wait(job[2], job[3], now)
+            if wait > 0:
+                self._hold(job, wait)
+                continue
+            self._tokens -= 1
+            task = asyncio.create_task(self._execute(job))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _execute(self, job: tuple) -> None:
+        priority, seq, chat_id, message, fn, args, kwargs, fut, tries = job
+        try:
+            result = await fn(*args, **kwargs)
+        except RetryAfter as e:
+            self.retries += 1
+            if tries + 1 >= self.max_tries:
+                if not fut.done():
+                    fut.set_exception(e)
+                return
+            self._paused[chat_id] = time.monotonic() + e.retry_after
+            self._hold((priority, seq, chat_id, message, fn, args, kwargs, fut, tries + 1), e.retry_after)
+        except Exception as e:
+            if not fut.done():
+                fut.set_exception(e)
+        else:
+            self.done += 1
+            if not fut.done():
+                fut.set_result(result)
+
+    async def close(self, timeout: float) -> None:
+        # sends merged notices now and gives queued calls up to timeout to finish
+        for key in list(self._notices):
+            self._flush_notice(key)
+        deadline = time.monotonic() + timeout
+        while (self._queue or self._held or self._running) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queued": len(self),
+            "done": self.done,
+            "retries": self.retries,
+            "failed": self.failed,
+            "merged": self.merged,
+        }
+
+outbox = Outbox(OUTBOX_RATE, OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST, OUTBOX_MERGE_WINDOW, OUTBOX_MAX_TRIES, OUTBOX_MAX_NAMES)
+
+# ----------------- Audit log -----------------
+# Every moderation action, by an admin or by the bot itself, is appended to
+# modlog. record() only buffers the row; the buffer goes to the storage thread
+# as one executemany when it fills up or on the next modlog_flush_job, and is
+# flushed ahead of any read. Pages are keyset cursors on (ts, id), so a deep
+# page costs the same as the first, and modlog_prune_job drops rows past the
+# retention a batch at a time, oldest first.
+MODLOG_TOP = (2**62, 0)  # cursor before the newest row
+
+def _q_add_modlog(conn: sqlite3.Connection, rows: List[tuple]) -> None:
+    conn.executemany(
+        "INSERT INTO modlog (chat_id, ts, actor_id, user_id, action, detail) VALUES (?,?,?,?,?,?)", rows
+    )
+
+def _q_modlog_page(
+    conn: sqlite3.Connection, chat_id: int, user_id: Optional[int], before: Tuple[int, int], limit: int
+) -> List[tuple]:
+    # rows strictly older than before = (ts, id), newest first
+    columns = "id, ts, actor_id, user_id, action, detail"
+    if user_id is None:
+        return conn.execute(
+            f"SELECT {columns} FROM modlog WHERE chat_id=? AND (ts, id) < (?, ?) ORDER BY ts DESC, id DESC LIMIT ?",
+            (chat_id, *before, limit),
+        ).fetchall()
+    return conn.execute(
+        f"SELECT {columns} FROM modlog WHERE user_id=? AND chat_id=? AND (ts, id) < (?, ?) "
+        "ORDER BY ts DESC, id DESC LIMIT ?",
+        (user_id, chat_id, *before, limit),
+    ).fetchall()
+
+def _q_prune_modlog(conn: sqlite3.Connection, cutoff: int, limit: int) -> int:
+    # a range on modlog_ts: only the rows being removed are read
+    return conn.execute(
+        "DELETE FROM modlog WHERE id IN (SELECT id FROM modlog WHERE ts < ? ORDER BY ts LIMIT ?)", (cutoff, limit)
+    ).rowcount
+
+class ModLog:
+    def __init__(self, batch: int):
+        self.batch = batch
+        self._rows: List[tuple] = []
+        self.recorded = 0
+        self.pruned = 0
+
+    def record(
+        self, chat_id: int, action: str, user_id: Optional[int] = None,
+        actor_id: Optional[int] = None, detail: Optional[str] = None,
+    ) -> None:
+        self._rows.append((chat_id, int(time.time()), actor_id, user_id, action, detail))
+        self.recorded += 1
+        if len(self._rows) >= self.batch:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._rows:
+            rows, self._rows = self._rows, []
+            db.submit(_q_add_modlog, rows)
+
+    async def page(
+        self, chat_id: int, user_id: Optional[int], before: Tuple[int, int], limit: int
+    ) -> List[tuple]:
+        self.flush()  # the executor is FIFO, so the read below sees these rows
+        return await db.run(_q_modlog_page, chat_id, user_id, before, limit)
+
+    async def prune(self, cutoff: int, batch: int) -> int:
+        total = 0
+        while True:
+            removed = await db.run(_q_prune_modlog, cutoff, batch)
+            total += removed
+            if removed < batch:
+                break
+        self.pruned += total
+        return total
+
+    def stats(self) -> Dict[str, int]:
+        return {"buffered": len(self._rows), "recorded": self.recorded, "pruned": self.pruned}
+
+modlog = ModLog(MODLOG_BATCH)
+
+async def modlog_flush_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    modlog.flush()
+
+async def modlog_prune_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    removed = await modlog.prune(int(time.time()) - MODLOG_RETENTION * 86400, MODLOG_PRUNE_BATCH)
+    if removed:
+        log.info("Audit log: pruned %d rows older than %d days", removed, MODLOG_RETENTION)
+
+# ----------------- Timed actions -----------------
+# Pending unmutes, unbans and unlocks live in timed_actions (indexed by due_at);
+# only the ones due soonest are held in a min-heap. `_cursor` is the (due_at,
+# id) position up to which every row is in memory: the tick job loads the next
+# slice once the heap runs low, so a restart -- or a few hundred thousand
+# pending actions -- only ever reads what is about to fire. Heap entries whose
+# action was cancelled or rescheduled are skipped when they surface.
+TIMED_NEVER = 2**62  # due_at of an action that waits for a command (e.g. /unlockchat)
+UNLOCKED_PERMISSIONS = ChatPermissions(
+    can_send_messages=True,
+    can_send_audios=True,
+    can_send_documents=True,
+    can_send_photos=True,
+    can_send_videos=True,
+    can_send_video_notes=True,
+    can_send_voice_notes=True,
+    can_send_polls=True,
+    can_send_other_messages=True,
+    can_add_web_page_previews=True,
+    can_invite_users=True,
+)
+
+def _q_schedule_action(
+    conn: sqlite3.Connection, chat_id: int, user_id: int, action: str, due_at: int, payload: Optional[str]
+) -> Tuple[int, Optional[str]]:
+    # a payload already stored wins: locking a locked chat must not replace
+    # the permissions an unlock restores
+    return conn.execute(
+        "INSERT INTO timed_actions (chat_id, user_id, action, due_at, payload) VALUES (?,?,?,?,?) "
+        "ON CONFLICT(chat_id,user_id,action) DO UPDATE SET due_at=excluded.due_at, "
+        "payload=COALESCE(timed_actions.payload, excluded.payload) "
+        "RETURNING id, payload",
+        (chat_id, user_id, action, due_at, payload),
+    ).fetchone()
+
+def _q_schedule_actions(
+    conn: sqlite3.Connection, chat_id: int, user_ids: List[int], action: str, due_at: int
+) -> List[Tuple[int, int]]:
+    # one transaction for a whole group; returns (user_id, id) per row
+    return [
+        (user_id, conn.execute(
+            "INSERT INTO timed_actions (chat_id, user_id, action, due_at) VALUES (?,?,?,?) "
+            "ON CONFLICT(chat_id,user_id,action) DO UPDATE SET due_at=excluded.due_at RETURNING id",
+            (chat_id, user_id, action, due_at),
+        ).fetchone()[0])
+        for user_id in user_ids
+    ]
+
+def _q_reschedule_actions(conn: sqlite3.Connection, chat_id: int, action: str, due_at: int) -> List[tuple]:
+    return conn.execute(
+        "UPDATE timed_actions SET due_at=? WHERE chat_id=? AND action=? RETURNING id, user_id, payload",
+        (due_at, chat_id, action),
+    ).fetchall()
+
+def _q_take_action(conn: sqlite3.Connection, chat_id: int, user_id: int, action: str) -> Optional[tuple]:
+    return conn.execute(
+        "DELETE FROM timed_actions WHERE chat_id=? AND user_id=? AND action=? RETURNING payload",
+        (chat_id, user_id, action),
+    ).fetchone()
+
+def _q_retry_action(conn: sqlite3.Connection, row_id: int, due_at: int, retry_at: int) -> bool:
+    return conn.execute(
+        "UPDATE timed_actions SET due_at=? WHERE id=? AND due_at=?", (retry_at, row_id, due_at)
+    ).rowcount > 0
+
+def _q_load_actions(conn: sqlite3.Connection, after: Tuple[int, int], until: int, limit: int) -> List[tuple]:
+    return conn.execute(
+        "SELECT due_at, id, chat_id, user_id, action, payload FROM timed_actions "
+        "WHERE (due_at, id) > (?, ?) AND due_at <= ? ORDER BY due_at, id LIMIT ?",
+        (*after, until, limit),
+    ).fetchall()
+
+def _q_finish_actions(conn: sqlite3.Connection, done: List[Tuple[int, int]]) -> None:
+    # (id, due_at): a row rescheduled while it was running stays
+    conn.executemany("DELETE FROM timed_actions WHERE id=? AND due_at=?", done)
+
+def _q_list_actions(conn: sqlite3.Connection, chat_id: int, limit: int) -> List[tuple]:
+    return conn.execute(
+        "SELECT user_id, action, due_at FROM timed_actions WHERE chat_id=? ORDER BY due_at LIMIT ?",
+        (chat_id, limit),
+    ).fetchall()
+
+class TimedActions:
+    def __init__(self, lookahead: int, load_batch: int, run_batch: int):
+        self.lookahead = lookahead
+        self.load_batch = load_batch
+        self.run_batch = run_batch
+        self._heap: List[tuple] = []  # (due_at, id, chat_id, user_id, action, payload)
+        self._live: Dict[Tuple[int, int, str], Tuple[int, int]] = {}  # key -> (due_at, id) of its heap entry
+        self._cursor: Tuple[int, int] = (-1, 0)
+        self.done = 0
+        self.failed = 0
+
+    async def schedule(self, chat_id: int, user_id: int, action: str, due_at: int, payload: Optional[str] = None) -> None:
+        row_id, payload = await db.run(_q_schedule_action, chat_id, user_id, action, due_at, payload)
+        self._track(chat_id, user_id, action, due_at, row_id, payload)
+
+    def _track(self, chat_id: int, user_id: int, action: str, due_at: int, row_id: int, payload: Optional[str]) -> None:
+        key = (chat_id, user_id, action)
+        if (due_at, row_id) <= self._cursor:
+            self._live[key] = (due_at, row_id)
+            heapq.heappush(self._heap, (due_at, row_id, chat_id, user_id, action, payload))
+        else:
+            self._live.pop(key, None)  # the next load picks it up
+
+    async def schedule_many(self, chat_id: int, user_ids: List[int], action: str, due_at: int) -> None:
+        for user_id, row_id in await db.run(_q_schedule_actions, chat_id, list(user_ids), action, due_at):
+            self._track(chat_id, user_id, action, due_at, row_id, None)
+
+    async def reschedule(self, chat_id: int, action: str, due_at: int) -> int:
+        # moves every pending `action` in the chat to due_at
+        rows = await db.run(_q_reschedule_actions, chat_id, action, due_at)
+        for row_id, user_id, payload in rows:
+            self._track(chat_id, user_id, action, due_at, row_id, payload)
+        return len(rows)
+
+    async def cancel(self, chat_id: int, user_id: int, action: str) -> Optional[tuple]:
+        # returns (payload,) if something was pending
+        self._live.pop((chat_id, user_id, action), None)
+        return await db.run(_q_take_action, chat_id, user_id, action)
+
+    async def _load(self, now: int) -> None:
+        # refill once half the lookahead is used up, so a quiet table costs
+        # one indexed query every lookahead/2 seconds
+        if self._cursor[0] >= now + self.lookahead // 2 or len(self._heap) >= self.load_batch:
+            return
+        until = now + self.lookahead
+        rows = await db.run(_q_load_actions, self._cursor, until, self.load_batch)
+        for row in rows:
+            due_at, row_id, chat_id, user_id, action, _ = row
+            self._live[(chat_id, user_id, action)] = (due_at, row_id)
+            heapq.heappush(self._heap, row)
+        self._cursor = rows[-1][:2] if len(rows) == self.load_batch else (until, sys.maxsize)
+
+    def _pop_due(self, now: int) -> List[tuple]:
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < self.run_batch:
+            entry = heapq.heappop(self._heap)
+            if self._live.get(entry[2:5]) == entry[:2]:
+                due.append(entry)
+        return due
+
+    async def _perform(self, bot, entry: tuple) -> bool:
+        # True once the row can go: done, or failed for good
+        due_at, row_id, chat_id, user_id, action, payload = entry
+        try:
+            # through the outbox, which already retries RetryAfter a few times
+            if action == "unmute":
+                await outbox.enforce(
+                    chat_id, bot.restrict_chat_member, chat_id, user_id, ChatPermissions(can_send_messages=True)
+                )
+            elif action == "unban":
+                await outbox.enforce(chat_id, bot.unban_chat_member, chat_id, user_id, only_if_banned=True)
+            elif action == "release":
+                # a joiner held by a lockdown; all permissions lifts the restriction
+                await outbox.enforce(
+                    chat_id, bot.restrict_chat_member, chat_id, user_id, ChatPermissions.all_permissions()
+                )
+            elif action == "unlock":
+                perms = ChatPermissions.de_json(json.loads(payload), bot) if payload else UNLOCKED_PERMISSIONS
+                await outbox.enforce(chat_id, bot.set_chat_permissions, chat_id, perms)
+            elif action == "unraid":
+                await set_chat_field(chat_id, "raid_until", 0)
+                await outbox.send(bot, chat_id, "✅ Lockdown lifted, new members are welcome again.")
+            modlog.record(chat_id, action, user_id or None, detail=None if action == "release" else "expired")
+            self.done += 1
+            return True
+        except RetryAfter as e:
+            delay = e.retry_after
+        except (BadRequest, Forbidden) as e:
+            # user left, bot lost its rights, chat gone...
+            log.info("Timed %s for %s in %s dropped: %s", action, user_id, chat_id, e)
+            self.failed += 1
+            return True
+        except TelegramError as e:
+            log.warning("Timed %s for %s in %s failed, retrying: %s", action, user_id, chat_id, e)
+            delay = TIMED_RETRY
+        retry_at = int(time.time() + delay)
+        if await db.run(_q_retry_action, row_id, due_at, retry_at) and self._live.get(entry[2:5]) == entry[:2]:
+            self._live[entry[2:5]] = (retry_at, row_id)
+            heapq.heappush(self._heap, (retry_at, row_id, chat_id, user_id, action, payload))
+        return False
+
+    async def tick(self, bot) -> None:
+        # one batch per tick keeps a backlog (say, after downtime) within the
+        # Bot API rate limits instead of bursting it all at once
+        now = int(time.time())
+        await self._load(now)
+        due = self._pop_due(now)
+        if not due:
+            return
+        results = await asyncio.gather(*(self._perform(bot, e) for e in due))
+        finished = []
+        for e, ok in zip(due, results):
+            if ok:
+                finished.append((e[1], e[0]))
+                if self._live.get(e[2:5]) == e[:2]:
+                    del self._live[e[2:5]]
+        if finished:
+            await db.run(_q_finish_actions, finished)
+
+    async def pending(self, chat_id: int, limit: int = 50) -> List[tuple]:
+        return await db.run(_q_list_actions, chat_id, limit)
+
+    def stats(self) -> Dict[str, int]:
+        return {"loaded": len(self._live), "heap": len(self._heap), "done": self.done, "failed": self.failed}
+
+timed = TimedActions(TIMED_LOOKAHEAD, TIMED_LOAD_BATCH, TIMED_RUN_BATCH)
+
+async def timed_actions_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await timed.tick(context.bot)
+
+def telegram_until(until: Optional[int]) -> Optional[int]:
+    # Telegram treats until_date under 30 seconds or over 366 days away as
+    # "forever"; those are lifted by the timed action instead
+    if until is None or not 30 <= until - time.time() <= 366 * 86400:
+        return None
+    return until
+
     # ----------------- Helpers -----------------
 
+# Per-chat admin roster loaded with get_chat_administrators and kept current from
+# ChatMemberUpdated events, so admin_only is a set lookup instead of an API call.
+class AdminCache:
+    def __init__(self, ttl: float, recheck: float):
+        self.ttl = ttl
+        self.recheck = recheck
+        self._rosters: Dict[int, Tuple[Set[int], float]] = {}  # chat_id -> (admin ids, loaded at)
+        self._loading: Dict[int, asyncio.Task] = {}
+        self.hits = 0
+        self.refreshes = 0
+
+    async def _load(self, bot, chat_id: int) -> Set[int]:
+        admins = await bot.get_chat_administrators(chat_id)
+        ids = {m.user.id for m in admins}
+        self._rosters[chat_id] = (ids, time.monotonic())
+        return ids
+
+    async def get(self, bot, chat_id: int, force: bool = False) -> Set[int]:
+        entry = self._rosters.get(chat_id)
+        if entry and not force and time.monotonic() - entry[1] < self.ttl:
+            self.hits += 1
+            return entry[0]
+        # concurrent commands in one chat share a single refresh
+        task = self._loading.get(chat_id)
+        if task is None:
+            self.refreshes += 1
+            task = asyncio.ensure_future(self._load(bot, chat_id))
+            self._loading[chat_id] = task
+            task.add_done_callback(lambda _: self._loading.pop(chat_id, None))
+        return await task
+
+    async def is_admin(self, bot, chat_id: int, user_id: int) -> bool:
+        if user_id in await self.get(bot, chat_id):
+            return True
+        # someone promoted outside our view (e.g. before the bot was an admin):
+        # allow one forced refresh per recheck interval
+        entry = self._rosters.get(chat_id)
+        if entry and time.monotonic() - entry[1] >= self.recheck:
+            return user_id in await self.get(bot, chat_id, force=True)
+        return False
+
+    def set_status(self, chat_id: int, user_id: int, is_admin: bool) -> None:
+        entry = self._rosters.get(chat_id)
+        if entry is None:
+            return
+        if is_admin:
+            entry[0].add(user_id)
+        else:
+            entry[0].discard(user_id)
+
+    def invalidate(self, chat_id: int) -> None:
+        self._rosters.pop(chat_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {"chats": len(self._rosters), "hits": self.hits, "refreshes": self.refreshes}
+
+admin_cache = AdminCache(ADMIN_CACHE_TTL, ADMIN_RECHECK)
+
 def admin_only(func: Callable):
     @wraps(func)
     async def wrapped(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -134,13 +1550,10 @@ def admin_only(func: Callable):
         try:
             chat_id = update.effective_chat.id
             user_id = update.effective_user.id
-            member = await context.bot.get_chat_member(chat_id, user_id)
-
-            if member.status not in ("administrator", "creator"):
+            if not await admin_cache.is_admin(context.bot, chat_id, user_id):
                 user_name = update.effective_user.mention_html()
                 await update.message.reply_text(
-                    f"❌ {user_name}, you are not an admin.\n\n"
-                    f"Your status: <b>{member.status}</b>",
+                    f"❌ {user_name}, you are not an admin.",
                     parse_mode=ParseMode.HTML
                 )
                 return
@@ -151,6 +1564,15 @@ def admin_only(func: Callable):
         return await func(update, context)
     return wrapped
 
+def sudo_only(func: Callable):
+    @wraps(func)
+    async def wrapped(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.effective_user.id not in SUDO_USERS:
+            await update.message.reply_text("❌ Only the bot's sudo users can do that.")
+            return
+        return await func(update, context)
+    return wrapped
+
 duration_re = re.compile(r"^(\d+)([smhd])$")
 def parse_duration(text: Optional[str]) -> Optional[int]:
     if not text:
@@ -168,6 +1590,16 @@ def parse_duration(text: Optional[str]) -> Optional[int]:
     if unit == "d": return val * 86400
     return None
 
+def format_remaining(seconds: int) -> str:
+    seconds = max(seconds, 0)
+    if seconds >= 86400:
+        return f"{seconds // 86400}d {seconds % 86400 // 3600}h"
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60}s"
+    return f"{seconds}s"
+
 def format_user(u: User) -> str:
     return f"{u.mention_html()} (ID: <code>{u.id}</code>)"
 
@@ -175,17 +1607,718 @@ def format_admin_info(update: Update) -> str:
     a = update.effective_user
     return f"{a.mention_html()} (ID: <code>{a.id}</code>)"
 
-def format_template(text: str, user: User) -> str:
+# ----------------- Templates -----------------
+TEMPLATE_FIELDS = ("first", "last", "fullname", "username", "mention", "id", "chatname", "count")
+TEMPLATE_HELP = " ".join(f"{{{f}}}" for f in TEMPLATE_FIELDS)
+_formatter = string.Formatter()
+
+class TemplateError(ValueError):
+    pass
+
+def _join_names(values: List[str], extra: int) -> str:
+    text = ", ".join(values)
+    if extra:
+        text += f" and {extra} others"
+    return text
+
+# A welcome/goodbye template parsed once into (literal, field, spec, conversion)
+# parts, so rendering is a fill and only the placeholders it uses get computed.
+class Template:
+    __slots__ = ("parts", "fields")
+
+    def __init__(self, text: str, validate: bool = True):
+        parts = []
+        try:
+            for literal, field, spec, conversion in _formatter.parse(text):
+                if field is not None and field not in TEMPLATE_FIELDS:
+                    raise TemplateError(f"unknown placeholder {{{field}}}")
+                parts.append((literal, field, spec, conversion))
+        except TemplateError:
+            raise
+        except ValueError as e:  # unbalanced braces and the like
+            raise TemplateError(str(e))
+        self.parts = tuple(parts)
+        self.fields = frozenset(p[1] for p in parts if p[1] is not None)
+        if validate:
+            try:
+                # the same types render_template passes: only count is a number
+                self.fill({f: 1 if f == "count" else "x" for f in self.fields})
+            except (ValueError, TypeError) as e:  # bad format spec or conversion
+                raise TemplateError(str(e))
+
+    @classmethod
+    def literal(cls, text: str) -> "Template":
+        t = cls.__new__(cls)
+        t.parts = ((text, None, "", None),)
+        t.fields = frozenset()
+        return t
+
+    def fill(self, values: Dict[str, Any]) -> str:
+        out = []
+        for literal, field, spec, conversion in self.parts:
+            out.append(literal)
+            if field is not None:
+                value = _formatter.convert_field(values[field], conversion)
+                out.append(_formatter.format_field(value, spec))
+        return "".join(out)
+
+@lru_cache(maxsize=4096)
+def get_template(text: str) -> Template:
+    # templates stored before validation existed are sent verbatim, as before
     try:
-        return text.format(
-            first=user.first_name or "",
-            last=user.last_name or "",
-            mention=user.mention_html(),
-            id=user.id,
-        )
-    except Exception:
+        return Template(text)
+    except TemplateError as e:
+        log.warning("Invalid stored template %r: %s", text, e)
+        return Template.literal(text)
+
+class _UnknownCount:
+    # stands in for {count} when the lookup fails; renders as "?" under any spec
+    def __format__(self, spec: str) -> str:
+        return "?"
+
+    def __str__(self) -> str:
+        return "?"
+
+    __repr__ = __str__
+
+UNKNOWN_COUNT = _UnknownCount()
+
+async def render_template(text: str, users: List[User], chat, bot, extra: int = 0) -> str:
+    t = get_template(text)
+    values: Dict[str, Any] = {}
+    for field in t.fields:
+        if field == "first":
+            values[field] = _join_names([html.escape(u.first_name or "") for u in users], extra)
+        elif field == "last":
+            values[field] = _join_names([html.escape(u.last_name or "") for u in users], extra)
+        elif field == "fullname":
+            values[field] = _join_names([html.escape(u.full_name) for u in users], extra)
+        elif field == "username":
+            values[field] = _join_names([f"@{u.username}" if u.username else html.escape(u.full_name) for u in users], extra)
+        elif field == "mention":
+            values[field] = _join_names([u.mention_html() for u in users], extra)
+        elif field == "id":
+            values[field] = ", ".join(str(u.id) for u in users)
+        elif field == "chatname":
+            values[field] = html.escape(chat.title or "")
+        elif field == "count":
+            # the batch is already taken off the queue; a failed lookup must not lose it
+            try:
+                values[field] = await bot.get_chat_member_count(chat.id)
+            except TelegramError as e:
+                log.warning("Could not get member count for %s: %s", chat.id, e)
+                values[field] = UNKNOWN_COUNT
+    try:
+        return t.fill(values)
+    except (ValueError, TypeError) as e:
+        # a spec validation let through; send the text as is rather than nothing
+        log.warning("Could not render template %r: %s", text, e)
         return text
 
+# ----------------- Link filter -----------------
+def normalize_domain(text: str) -> str:
+    text = text.strip().lower()
+    if text == "*":
+        return text
+    if "://" not in text:
+        text = "http://" + text
+    try:
+        host = urlsplit(text).hostname or ""
+    except ValueError:
+        return ""
+    return host.rstrip(".")
+
+# domain -> True (block) / False (allow), matched on the longest suffix of the
+# host, so a lookup costs one dict probe per label whatever the list sizes.
+# "*" in the block list blocks every domain that is not allow-listed.
+class LinkMatcher:
+    __slots__ = ("rules", "block_all")
+
+    def __init__(self, allow: str, block: str):
+        self.rules: Dict[str, bool] = {d: True for d in DEFAULT_LINK_BLOCK}
+        self.rules.update((d, True) for d in block.split())
+        self.rules.update((d, False) for d in allow.split())
+        self.block_all = self.rules.pop("*", False)
+
+    def blocks(self, host: str) -> bool:
+        labels = host.split(".")
+        for i in range(len(labels)):
+            verdict = self.rules.get(".".join(labels[i:]))
+            if verdict is not None:
+                return verdict
+        return self.block_all
+
+# keyed on the list contents, so a matcher is rebuilt only when a chat's lists
+# change (and chats with identical lists share one)
+@lru_cache(maxsize=4096)
+def get_link_matcher(allow: str, block: str) -> LinkMatcher:
+    return LinkMatcher(allow, block)
+
+def message_hosts(message) -> List[str]:
+    hosts = []
+    for entities, parse in (
+        (message.entities, message.parse_entity),
+        (message.caption_entities, message.parse_caption_entity),
+    ):
+        for e in entities:
+            if e.type == MessageEntity.URL:
+                url = parse(e)
+            elif e.type == MessageEntity.TEXT_LINK:
+                url = e.url
+            else:
+                continue
+            host = normalize_domain(url)
+            if host:
+                hosts.append(host)
+    return hosts
+
+def has_blocked_link(message, s: ChatSettings) -> bool:
+    if not message.entities and not message.caption_entities:
+        return False
+    matcher = get_link_matcher(s.link_allow, s.link_block)
+    return any(matcher.blocks(h) for h in message_hosts(message))
+
+# Media locks: /lock <type> deletes every message of that type from non-admins.
+LOCK_TYPES: Dict[str, Callable] = {
+    "photo": lambda m: m.photo,
+    "video": lambda m: m.video,
+    "gif": lambda m: m.animation,
+    "sticker": lambda m: m.sticker,
+    "voice": lambda m: m.voice,
+    "videonote": lambda m: m.video_note,
+    "audio": lambda m: m.audio,
+    "document": lambda m: m.document and not m.animation,  # gifs carry a document too
+    "poll": lambda m: m.poll,
+    "contact": lambda m: m.contact,
+    "location": lambda m: m.location or m.venue,
+    "dice": lambda m: m.dice,
+    "game": lambda m: m.game,
+    "story": lambda m: m.story,
+    "forward": lambda m: m.forward_origin,
+    "inline": lambda m: m.via_bot,
+}
+
+@lru_cache(maxsize=1024)
+def lock_checks(locks: str) -> Tuple[Tuple[str, Callable], ...]:
+    return tuple((t, LOCK_TYPES[t]) for t in locks.split() if t in LOCK_TYPES)
+
+# ----------------- Word filters -----------------
+FILTER_ACTIONS = ("delete", "warn", "mute")  # mildest first
+
+def normalize_phrase(text: str) -> str:
+    return " ".join(text.casefold().split())
+
+def _q_get_filters(conn: sqlite3.Connection, chat_id: int) -> List[tuple]:
+    return conn.execute("SELECT pattern, action FROM filters WHERE chat_id=? ORDER BY pattern", (chat_id,)).fetchall()
+
+def _q_add_filter(conn: sqlite3.Connection, chat_id: int, pattern: str, action: str, limit: int) -> bool:
+    # False when the chat already has `limit` other filters
+    exists = conn.execute("SELECT 1 FROM filters WHERE chat_id=? AND pattern=?", (chat_id, pattern)).fetchone()
+    if not exists and conn.execute("SELECT COUNT(*) FROM filters WHERE chat_id=?", (chat_id,)).fetchone()[0] >= limit:
+        return False
+    conn.execute(
+        "INSERT INTO filters (chat_id, pattern, action) VALUES (?,?,?) "
+        "ON CONFLICT(chat_id,pattern) DO UPDATE SET action=excluded.action",
+        (chat_id, pattern, action),
+    )
+    return True
+
+def _q_remove_filter(conn: sqlite3.Connection, chat_id: int, pattern: str) -> bool:
+    return conn.execute("DELETE FROM filters WHERE chat_id=? AND pattern=?", (chat_id, pattern)).rowcount > 0
+
+# Aho-Corasick automaton over a chat's casefolded phrases: one pass over the
+# message finds every occurrence of every phrase, so the cost grows with the
+# message, not with the number of filters. A phrase edge that is a letter or
+# digit only matches at a word boundary ("ass" does not hit "class").
+class PhraseMatcher:
+    __slots__ = ("patterns", "_goto", "_fail", "_out", "_link")
+
+    def __init__(self, patterns: List[Tuple[str, str]]):
+        self.patterns = patterns  # (phrase, action)
+        goto: List[Dict[str, int]] = [{}]
+        out = [-1]  # pattern ending at the node
+        for i, (phrase, _) in enumerate(patterns):
+            node = 0
+            for ch in phrase:
+                nxt = goto[node].get(ch)
+                if nxt is None:
+                    nxt = goto[node][ch] = len(goto)
+                    goto.append({})
+                    out.append(-1)
+                node = nxt
+            out[node] = i
+        fail = [0] * len(goto)
+        link = [-1] * len(goto)  # nearest proper suffix node where a pattern ends
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in goto[node].items():
+                f = fail[node]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0)
+                link[nxt] = fail[nxt] if out[fail[nxt]] >= 0 else link[fail[nxt]]
+                queue.append(nxt)
+        self._goto, self._fail, self._out, self._link = goto, fail, out, link
+
+    def search(self, text: str) -> Optional[Tuple[str, str]]:
+        # the matched (phrase, action) with the strictest action, or None
+        goto, fail, out, link = self._goto, self._fail, self._out, self._link
+        text = normalize_phrase(text)
+        best, rank = None, -1
+        node = 0
+        for end, ch in enumerate(text, 1):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            hit = node if out[node] >= 0 else link[node]
+            while hit > 0:
+                phrase, action = self.patterns[out[hit]]
+                start = end - len(phrase)
+                if (
+                    (start == 0 or not phrase[0].isalnum() or not text[start - 1].isalnum())
+                    and (end == len(text) or not phrase[-1].isalnum() or not text[end].isalnum())
+                    and FILTER_ACTIONS.index(action) > rank
+                ):
+                    best, rank = (phrase, action), FILTER_ACTIONS.index(action)
+                    if rank == len(FILTER_ACTIONS) - 1:
+                        return best
+                hit = link[hit]
+        return best
+
+# chat_id -> (filter_version, matcher). The version lives in the chat's
+# settings and is bumped on every change, so a matcher is rebuilt only after
+# its chat's list changed, and chats that never had filters skip all of this.
+class FilterCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[int, Tuple[int, Optional[PhraseMatcher]]]" = OrderedDict()
+        self.builds = 0
+
+    async def get(self, chat_id: int, version: int) -> Optional[PhraseMatcher]:
+        entry = self._data.get(chat_id)
+        if entry is not None and entry[0] == version:
+            self._data.move_to_end(chat_id)
+            return entry[1]
+        rows = await db.run(_q_get_filters, chat_id)
+        matcher = PhraseMatcher(rows) if rows else None
+        self.builds += 1
+        self._data[chat_id] = (version, matcher)
+        self._data.move_to_end(chat_id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        return matcher
+
+    def stats(self) -> Dict[str, int]:
+        return {"chats": len(self._data), "builds": self.builds}
+
+filter_cache = FilterCache(SETTINGS_CACHE_SIZE)
+
+async def match_filters(message, s: ChatSettings) -> Optional[Tuple[str, str]]:
+    if not s.filter_version:
+        return None
+    text = message.text or message.caption
+    if not text:
+        return None
+    matcher = await filter_cache.get(message.chat_id, s.filter_version)
+    return matcher.search(text) if matcher else None
+
+# ----------------- Duplicate detection -----------------
+# Fingerprints of recent message texts, shared by every chat the bot manages.
+# Text is casefolded and stripped of everything but letters and digits, so
+# spacing and punctuation tricks hash alike. Once one payload has come from
+# `chats` distinct chats or `users` distinct senders within the window it is
+# flagged: the copies seen so far are returned for removal, and so is every
+# further copy until it goes quiet for a window. Keys are LRU-capped and each
+# entry keeps at most `max_hits` message refs, so memory is fixed.
+_DUP_STRIP = re.compile(r"[\W_]+")
+
+class _Payload:
+    __slots__ = ("first", "last", "chats", "users", "hits", "flagged")
+
+    def __init__(self, now: float, max_hits: int):
+        self.first = now
+        self.last = now
+        self.chats: Set[int] = set()
+        self.users: Set[int] = set()
+        self.hits: deque = deque(maxlen=max_hits)  # (chat_id, message_id, user_id)
+        self.flagged = False
+
+class DuplicateIndex:
+    def __init__(self, max_keys: int, window: float, chats: int, users: int, min_len: int):
+        self.max_keys = max_keys
+        self.window = window
+        self.chats = chats
+        self.users = users
+        self.min_len = min_len
+        self._data: "OrderedDict[int, _Payload]" = OrderedDict()
+        self.evictions = 0
+        self.caught = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def check(self, chat_id: int, user_id: int, message_id: int, text: str, now: float) -> List[Tuple[int, int, int]]:
+        # records the message; returns the (chat_id, message_id, user_id) copies to act on
+        text = _DUP_STRIP.sub("", text.casefold())
+        if len(text) < self.min_len:
+            return []
+        key = hash(text)
+        p = self._data.pop(key, None)
+        if p is None or now - (p.last if p.flagged else p.first) > self.window:
+            p = _Payload(now, max(self.chats, self.users))
+            if len(self._data) >= self.max_keys:
+                self._data.popitem(last=False)
+                self.evictions += 1
+        self._data[key] = p
+        p.last = now
+        if p.flagged:
+            self.caught += 1
+            return [(chat_id, message_id, user_id)]
+        p.chats.add(chat_id)
+        p.users.add(user_id)
+        p.hits.append((chat_id, message_id, user_id))
+        if len(p.chats) < self.chats and len(p.users) < self.users:
+            return []
+        p.flagged = True
+        hits = list(p.hits)
+        p.chats.clear()
+        p.users.clear()
+        p.hits.clear()
+        self.caught += len(hits)
+        return hits
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "keys": len(self._data),
+            "max_keys": self.max_keys,
+            "flagged": sum(p.flagged for p in self._data.values()),
+            "caught": self.caught,
+            "evictions": self.evictions,
+        }
+
+duplicates = DuplicateIndex(DUP_MAX_KEYS, DUP_WINDOW, DUP_CHATS, DUP_USERS, DUP_MIN_LEN)
+
+async def remove_duplicates(bot, hits: List[Tuple[int, int, int]]) -> None:
+    # deletes every copy and mutes its sender, leaving admins' messages alone
+    until = int(time.time()) + DUP_MUTE
+    for chat_id, message_id, user_id in hits:
+        try:
+            if user_id in await admin_cache.get(bot, chat_id):
+                continue
+        except TelegramError as e:
+            log.info("Admin check in %s failed: %s", chat_id, e)
+        outbox.enforce(chat_id, bot.delete_message, chat_id, message_id)
+        outbox.enforce(
+            chat_id, bot.restrict_chat_member, chat_id, user_id,
+            ChatPermissions(can_send_messages=False), until_date=telegram_until(until),
+        )
+        outbox.notice(
+            bot, chat_id, "🧹 Cross-posted spam removed, muted {}.", f'<a href="tg://user?id={user_id}">{user_id}</a>'
+        )
+        modlog.record(chat_id, "mute", user_id, detail=f"cross-posted spam, {format_remaining(DUP_MUTE)}")
+        await timed.schedule(chat_id, user_id, "unmute", until)
+
+# ----------------- Seen users -----------------
+# Everyone the bot has seen post, join or leave, so commands can name their
+# targets by @username or id instead of a reply. Profiles sit in an LRU with a
+# username -> id map beside it; new and changed profiles are queued and
+# upserted in one batch by users_flush_job. A lookup that misses the LRU reads
+# the users table; nothing here calls the Bot API.
+username_re = re.compile(r"^@[A-Za-z0-9_]{4,32}$")
+
+def _q_upsert_users(conn: sqlite3.Connection, rows: List[tuple]) -> None:
+    # rows of (user_id, username, first_name, last_name); a username moves to
+    # whoever holds it now
+    conn.executemany(
+        "UPDATE users SET username=NULL WHERE username=? COLLATE NOCASE AND user_id<>?",
+        [(r[1], r[0]) for r in rows if r[1]],
+    )
+    conn.executemany(
+        "INSERT INTO users (user_id, username, first_name, last_name) VALUES (?,?,?,?) "
+        "ON CONFLICT(user_id) DO UPDATE SET "
+        "username=excluded.username, first_name=excluded.first_name, last_name=excluded.last_name",
+        rows,
+    )
+
+def _q_get_user(conn: sqlite3.Connection, user_id: int) -> Optional[tuple]:
+    return conn.execute(
+        "SELECT user_id, username, first_name, last_name FROM users WHERE user_id=?", (user_id,)
+    ).fetchone()
+
+def _q_find_username(conn: sqlite3.Connection, username: str) -> Optional[tuple]:
+    return conn.execute(
+        "SELECT user_id, username, first_name, last_name FROM users WHERE username=? COLLATE NOCASE", (username,)
+    ).fetchone()
+
+class SeenUsers:
+    def __init__(self, maxsize: int, batch: int):
+        self.maxsize = maxsize
+        self.batch = batch
+        self._profiles: "OrderedDict[int, tuple]" = OrderedDict()  # user_id -> (username, first_name, last_name)
+        self._names: Dict[str, int] = {}  # casefolded username -> user_id, for profiles in the LRU
+        self._dirty: Dict[int, tuple] = {}
+        self.hits = 0
+        self.misses = 0
+        self.written = 0
+
+    def __len__(self) -> int:
+        return len(self._profiles)
+
+    def _put(self, user_id: int, profile: tuple) -> None:
+        old = self._profiles.pop(user_id, None)
+        if old and old[0] and self._names.get(old[0].casefold()) == user_id:
+            del self._names[old[0].casefold()]
+        if profile[0]:
+            self._names[profile[0].casefold()] = user_id
+        self._profiles[user_id] = profile
+        while len(self._profiles) > self.maxsize:
+            evicted, (username, _, _) = self._profiles.popitem(last=False)
+            if username and self._names.get(username.casefold()) == evicted:
+                del self._names[username.casefold()]
+
+    def seen(self, user: User) -> None:
+        profile = (user.username, user.first_name, user.last_name)
+        if self._profiles.get(user.id) == profile:
+            self._profiles.move_to_end(user.id)
+            return
+        self._put(user.id, profile)
+        self._dirty[user.id] = profile
+        if len(self._dirty) >= self.batch:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._dirty:
+            rows = [(user_id, *profile) for user_id, profile in self._dirty.items()]
+            self._dirty = {}
+            db.submit(_q_upsert_users, rows)
+            self.written += len(rows)
+
+    async def _load(self, fn: Callable, key: Any) -> Optional[tuple]:
+        self.misses += 1
+        self.flush()  # profiles evicted before their upsert ran are in this batch
+        row = await db.run(fn, key)
+        if row:
+            self._put(row[0], row[1:])
+        return row
+
+    async def resolve(self, token: str) -> Optional[User]:
+        # "@username" or a numeric id; an id nobody has seen still resolves,
+        # since the Bot API only needs the id
+        if token.isdigit():
+            user_id = int(token)
+            profile = self._profiles.get(user_id)
+            if profile is not None:
+                self.hits += 1
+            else:
+                row = await self._load(_q_get_user, user_id)
+                profile = row[1:] if row else (None, token, None)
+        elif username_re.match(token):
+            user_id = self._names.get(token[1:].casefold())
+            if user_id is not None:
+                self.hits += 1
+                profile = self._profiles[user_id]
+            else:
+                row = await self._load(_q_find_username, token[1:])
+                if row is None:
+                    return None
+                user_id, profile = row[0], row[1:]
+        else:
+            return None
+        username, first_name, last_name = profile
+        return User(user_id, first_name or str(user_id), False, last_name=last_name, username=username)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._profiles),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "written": self.written,
+        }
+
+seen_users = SeenUsers(USERS_CACHE_SIZE, USERS_BATCH)
+
+async def users_flush_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    seen_users.flush()
+
+def is_target(token: str) -> bool:
+    return token.isdigit() or username_re.match(token) is not None
+
+async def resolve_targets(update: Update, args: List[str]) -> Tuple[List[User], List[str]]:
+    # the replied-to user, then every leading @username or id, which are taken
+    # off args; also returns the tokens nobody is known by
+    targets = []
+    reply = update.message.reply_to_message
+    if reply and reply.from_user:
+        seen_users.seen(reply.from_user)
+        targets.append(reply.from_user)
+    missing = []
+    while args and is_target(args[0]):
+        token = args.pop(0)
+        user = await seen_users.resolve(token)
+        if user is None:
+            missing.append(token)
+        else:
+            targets.append(user)
+    return targets, missing
+
+def pop_duration(update: Update, args: List[str]) -> Optional[str]:
+    # takes a trailing duration off args. Without a reply the arguments are
+    # targets, so a bare number is an id there and a duration needs its unit
+    if not args:
+        return None
+    if update.message.reply_to_message:
+        ok = bool(parse_duration(args[-1]))
+    else:
+        ok = duration_re.match(args[-1].strip().lower()) is not None
+    return args.pop() if ok else None
+
+async def for_each_target(
+    update: Update, targets: List[User], missing: List[str], verb: str, action: Callable
+) -> None:
+    # runs action(user) -> reply line for each target and answers with one message
+    lines = []
+    for user in targets:
+        try:
+            lines.append(await action(user))
+        except Exception as e:
+            lines.append(f"❌ Could not {verb} {format_user(user)}: {html.escape(str(e))}")
+    lines += [f"❓ {html.escape(token)} hasn't been seen here yet, reply to one of their messages." for token in missing]
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+
+# ----------------- Global bans -----------------
+# One ban list for every chat the bot manages. The ids live in gbans and in an
+# in-memory set (loaded page by page at startup), so the checks on every join
+# and message are a set lookup. A new /gban is also pushed to every known
+# group by gban_fanout_job, one batch of chats per tick through the outbox;
+# imports are enforced only as listed users join or speak.
+def _q_gban_page(conn: sqlite3.Connection, after: int, limit: int) -> List[tuple]:
+    return conn.execute(
+        "SELECT user_id, reason FROM gbans WHERE user_id > ? ORDER BY user_id LIMIT ?", (after, limit)
+    ).fetchall()
+
+def _q_add_gbans(conn: sqlite3.Connection, rows: List[tuple], replace: bool) -> int:
+    # rows of (user_id, reason, banned_by, ts); returns how many were new
+    before = conn.total_changes
+    verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+    conn.executemany(f"{verb} INTO gbans (user_id, reason, banned_by, ts) VALUES (?,?,?,?)", rows)
+    return conn.total_changes - before
+
+def _q_remove_gban(conn: sqlite3.Connection, user_id: int) -> bool:
+    return conn.execute("DELETE FROM gbans WHERE user_id=?", (user_id,)).rowcount > 0
+
+def _q_group_page(conn: sqlite3.Connection, after: int, limit: int) -> List[int]:
+    rows = conn.execute(
+        "SELECT chat_id FROM chats WHERE chat_id > ? AND chat_id < 0 ORDER BY chat_id LIMIT ?", (after, limit)
+    ).fetchall()
+    return [r[0] for r in rows]
+
+def parse_gban_line(line: str, by: int, now: int) -> Optional[tuple]:
+    # "<user_id>[,reason]"; blank lines and # comments are skipped
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    user_id, _, reason = line.partition(",")
+    try:
+        return int(user_id), reason.strip() or None, by, now
+    except ValueError:
+        return None
+
+class GlobalBans:
+    def __init__(self, page: int, fanout_batch: int):
+        self.page = page
+        self.fanout_batch = fanout_batch
+        self._ids: Set[int] = set()
+        self._fanout: deque = deque()  # [action, user_id, last chat_id done]
+        self.enforced = 0
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    async def load(self) -> None:
+        after = -1
+        while True:
+            rows = await db.run(_q_gban_page, after, self.page)
+            self._ids.update(r[0] for r in rows)
+            if len(rows) < self.page:
+                break
+            after = rows[-1][0]
+        log.info("⛔ %d global bans loaded", len(self._ids))
+
+    async def add(self, user_id: int, reason: Optional[str], by: int) -> None:
+        await db.run(_q_add_gbans, [(user_id, reason, by, int(time.time()))], True)
+        self._ids.add(user_id)
+        self._fanout.append(["ban", user_id, -(2**63)])
+
+    async def remove(self, user_id: int) -> bool:
+        if not await db.run(_q_remove_gban, user_id):
+            return False
+        self._ids.discard(user_id)
+        self._fanout.append(["unban", user_id, -(2**63)])
+        return True
+
+    async def import_file(self, path: str, by: int, skip: Set[int]) -> int:
+        # reads and inserts one page of lines at a time; returns the number of new bans.
+        # ids in skip are never banned, the same as for /gban
+        added = 0
+        now = int(time.time())
+        with open(path, encoding="utf-8", errors="replace") as f:
+            while True:
+                lines = list(itertools.islice(f, self.page))
+                if not lines:
+                    break
+                rows = [r for r in (parse_gban_line(line, by, now) for line in lines) if r and r[0] not in skip]
+                if rows:
+                    added += await db.run(_q_add_gbans, rows, False)
+                    self._ids.update(r[0] for r in rows)
+        return added
+
+    async def export_file(self, path: str) -> int:
+        count = 0
+        after = -1
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("# user_id,reason\n")
+            while True:
+                rows = await db.run(_q_gban_page, after, self.page)
+                f.writelines(f"{uid},{reason or ''}\n" for uid, reason in rows)
+                count += len(rows)
+                if len(rows) < self.page:
+                    return count
+                after = rows[-1][0]
+
+    async def fanout_tick(self, bot) -> None:
+        if not self._fanout:
+            return
+        job = self._fanout[0]
+        action, user_id, after = job
+        chats = await db.run(_q_group_page, after, self.fanout_batch)
+        fn = bot.ban_chat_member if action == "ban" else bot.unban_chat_member
+        kwargs = {} if action == "ban" else {"only_if_banned": True}
+        for chat_id in chats:
+            outbox.enforce(chat_id, fn, chat_id, user_id, **kwargs)
+        if len(chats) < self.fanout_batch:
+            self._fanout.popleft()
+            log.info("Global %s of %s sent to all chats", action, user_id)
+        else:
+            job[2] = chats[-1]
+
+    def enforce(self, bot, chat_id: int, user_id: int) -> None:
+        self.enforced += 1
+        modlog.record(chat_id, "ban", user_id, detail="global ban")
+        outbox.enforce(chat_id, bot.ban_chat_member, chat_id, user_id)
+
+    def stats(self) -> Dict[str, int]:
+        return {"users": len(self._ids), "fanouts": len(self._fanout), "enforced": self.enforced}
+
+gbans = GlobalBans(GBAN_PAGE, GBAN_FANOUT_BATCH)
+
+async def gban_fanout_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await gbans.fanout_tick(context.bot)
+
 # ----------------- Commands & Handlers -----------------
 
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -195,13 +2328,15 @@ async def cmd_cmds(update: Update, context: ContextTypes.DEFAULT_TYPE):
     txt = (
         "📋 <b>Command List</b>\n\n"
         "👮 Moderation:\n"
-        "/warn, /warnings, /resetwarns, /mute, /unmute, /ban, /unban, /kick, /promote, /demote, /purge\n\n"
+        "/warn, /warnings, /resetwarns, /mute, /unmute, /mutes, /modlog, /ban, /tempban, /unban, /kick, /promote, /demote, /purge\n\n"
         "⚙️ Group Settings:\n"
-        "/rules, /setrules, /setwarnlimit, /antilink, /slowmode, /settings\n\n"
+        "/lockchat, /unlockchat, /rules, /setrules, /setwarnlimit, /setwarnexpiry, /antilink, /dupguard, /lock, /unlock, /locks, /allowlink, /blocklink, /unlistlink, /linklists, /addfilter, /rmfilter, /filters, /slowmode, /setflood, /setfloodmute, /raidmode, /lockdown, /settings\n\n"
+        "⛔ Global bans (sudo users):\n"
+        "/gban, /ungban, /gbanimport, /gbanexport\n\n"
         "👋 Welcome/Goodbye:\n"
-        "/setwelcome, /resetwelcome, /testwelcome, /setgoodbye, /resetgoodbye, /testgoodbye\n\n"
+        "/setwelcome, /resetwelcome, /testwelcome, /welcomewindow, /cleanwelcome, /setgoodbye, /resetgoodbye, /testgoodbye\n\n"
         "🔧 Utilities:\n"
-        "/id, /userinfo, /echo, /help, /cmds"
+        "/id, /userinfo, /echo, /botstats, /help, /cmds"
     )
     await update.message.reply_text(txt, parse_mode=ParseMode.HTML)
 
@@ -225,8 +2360,13 @@ async def cmd_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_userinfo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     target = update.message.reply_to_message.from_user if update.message.reply_to_message else update.effective_user
+    if context.args:
+        target = await seen_users.resolve(context.args[0])
+        if target is None:
+            await update.message.reply_text("❓ I haven't seen that user yet.")
+            return
     txt = (
-        f"👤 <b>{target.full_name}</b>\n"
+        f"👤 <b>{html.escape(target.full_name)}</b>\n"
         f"ID: <code>{target.id}</code>\n"
         f"Username: @{target.username or 'N/A'}\n"
         f"Is bot: {target.is_bot}"
@@ -239,12 +2379,56 @@ async def cmd_echo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Usage: /echo <text>")
         return
     await update.message.reply_text(txt)
+
+@admin_only
+async def cmd_botstats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    c = settings_cache.stats()
+    a = admin_cache.stats()
+    f = flood.stats()
+    u = update_processor.stats()
+    d = db.stats()
+    st = state.stats()
+    t = timed.stats()
+    o = outbox.stats()
+    r = raid.stats()
+    fc = filter_cache.stats()
+    dp = duplicates.stats()
+    pl = " · ".join(f"{name} {n}/{acted} {us:.0f}µs" for name, (n, acted, us) in pipeline.stats().items())
+    gb = gbans.stats()
+    ml = modlog.stats()
+    su = seen_users.stats()
+    txt = (
+        f"📊 <b>Bot Stats</b>\n\n"
+        f"Settings cache: {c['size']}/{c['maxsize']} chats, "
+        f"{c['hits']} hits, {c['misses']} misses, {c['evictions']} evictions\n"
+        f"Admin cache: {a['chats']} chats, {a['hits']} hits, {a['refreshes']} refreshes\n"
+        f"Flood tracker: {f['keys']}/{f['max_keys']} keys, {f['evictions']} evictions, ~{f['bytes'] // 1024} KiB\n"
+        f"Updates: {u['active_chats']}/{u['max_concurrent']} chats busy, {u['queued']} queued "
+        f"(peak {u['max_queued']}), {u['processed']} processed\n"
+        f"Database: {d['queries']} round trips, {d['pending']} writes pending, "
+        f"{d['batched_ops']} writes in {d['batches']} batches\n"
+        f"Pipeline (runs/actions, mean): {pl}; {pipeline.plans_built} plans built\n"
+        f"Seen users: {su['size']}/{su['maxsize']} cached, {su['hits']} hits, {su['misses']} misses, "
+        f"{su['written']} upserted\n"
+        f"Audit log: {ml['recorded']} recorded, {ml['buffered']} buffered, {ml['pruned']} pruned\n"
+        f"Global bans: {gb['users']} users, {gb['fanouts']} fan-outs running, {gb['enforced']} enforced\n"
+        f"Duplicates: {dp['keys']}/{dp['max_keys']} fingerprints, {dp['flagged']} flagged, "
+        f"{dp['caught']} copies caught\n"
+        f"Word filters: {fc['chats']} chats cached, {fc['builds']} builds\n"
+        f"Raid monitor: {r['chats']} chats, {r['held']} joiners held, {r['lockdowns']} lockdowns\n"
+        f"Outbox: {o['queued']} queued, {o['done']} sent, {o['retries']} flood waits, "
+        f"{o['failed']} failed, {o['merged']} notices merged\n"
+        f"Timed actions: {t['loaded']} loaded, {t['done']} done, {t['failed']} dropped\n"
+        f"Shared state: {state.name}"
+        + (f", {st['round_trips']} round trips, {st['fallbacks']} local fallbacks" if st else "")
+    )
+    await update.message.reply_text(txt, parse_mode=ParseMode.HTML)
     # ----------------- Group Settings -----------------
 
 @admin_only
 async def cmd_rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    s = get_chat(update.effective_chat.id)
-    await update.message.reply_text(f"📜 <b>Rules</b>:\n{s['rules']}", parse_mode=ParseMode.HTML)
+    s = await get_chat(update.effective_chat.id)
+    await update.message.reply_text(f"📜 <b>Rules</b>:\n{s.rules}", parse_mode=ParseMode.HTML)
 
 @admin_only
 async def cmd_setrules(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -252,7 +2436,7 @@ async def cmd_setrules(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not text:
         await update.message.reply_text("Usage: /setrules <text>")
         return
-    set_chat_field(update.effective_chat.id, "rules", text)
+    await set_chat_field(update.effective_chat.id, "rules", text)
     await update.message.reply_text("✅ Rules updated.")
 
 @admin_only
@@ -262,20 +2446,119 @@ async def cmd_setwarnlimit(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     try:
         n = int(context.args[0])
-        set_chat_field(update.effective_chat.id, "warn_limit", n)
+        await set_chat_field(update.effective_chat.id, "warn_limit", n)
         await update.message.reply_text(f"✅ Warn limit set to {n}.")
     except Exception:
         await update.message.reply_text("❌ Invalid number.")
 
+@admin_only
+async def cmd_setwarnexpiry(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args:
+        await update.message.reply_text("Usage: /setwarnexpiry <duration>|off (e.g. 7d, 12h)")
+        return
+    if context.args[0].lower() == "off":
+        duration = 0
+    else:
+        duration = parse_duration(context.args[0])
+        if not duration:
+            await update.message.reply_text("❌ Invalid duration.")
+            return
+    await set_chat_field(update.effective_chat.id, "warn_expiry", duration)
+    if duration:
+        await update.message.reply_text(f"✅ Warnings now expire {context.args[0]} after the latest one.")
+    else:
+        await update.message.reply_text("✅ Warnings no longer expire.")
+
 @admin_only
 async def cmd_antilink(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args or context.args[0].lower() not in ("on", "off"):
         await update.message.reply_text("Usage: /antilink on|off")
         return
     val = 1 if context.args[0].lower() == "on" else 0
-    set_chat_field(update.effective_chat.id, "anti_link", val)
+    await set_chat_field(update.effective_chat.id, "anti_link", val)
     await update.message.reply_text(f"✅ Anti-link {'enabled' if val else 'disabled'}.")
 
+@admin_only
+async def cmd_dupguard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args or context.args[0].lower() not in ("on", "off"):
+        await update.message.reply_text("Usage: /dupguard on|off")
+        return
+    val = 1 if context.args[0].lower() == "on" else 0
+    await set_chat_field(update.effective_chat.id, "dup_guard", val)
+    await update.message.reply_text(f"✅ Cross-chat duplicate detection {'enabled' if val else 'disabled'}.")
+
+LOCKS_USAGE = "Types: " + ", ".join(LOCK_TYPES)
+
+@admin_only
+async def cmd_lock(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    types = [t.lower() for t in context.args]
+    if not types or any(t not in LOCK_TYPES for t in types):
+        await update.message.reply_text(f"Usage: /lock <type> [type...]\n{LOCKS_USAGE}")
+        return
+    chat_id = update.effective_chat.id
+    s = await get_chat(chat_id)
+    locks = set(s.locks.split()) | set(types)
+    await set_chat_field(chat_id, "locks", " ".join(t for t in LOCK_TYPES if t in locks))
+    await update.message.reply_text(f"🔒 Locked {', '.join(types)}: such messages from members will be deleted.")
+
+@admin_only
+async def cmd_unlock(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    types = [t.lower() for t in context.args]
+    if not types or any(t not in LOCK_TYPES and t != "all" for t in types):
+        await update.message.reply_text(f"Usage: /unlock <type> [type...] or /unlock all\n{LOCKS_USAGE}")
+        return
+    chat_id = update.effective_chat.id
+    s = await get_chat(chat_id)
+    locks = set() if "all" in types else set(s.locks.split()) - set(types)
+    await set_chat_field(chat_id, "locks", " ".join(t for t in LOCK_TYPES if t in locks))
+    await update.message.reply_text(f"🔓 Unlocked {', '.join(types)}.")
+
+@admin_only
+async def cmd_locks(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    s = await get_chat(update.effective_chat.id)
+    locked = s.locks.split()
+    lines = [f"{'🔒' if t in locked else '🔓'} {t}" for t in LOCK_TYPES]
+    await update.message.reply_text("<b>Locks</b>\n" + "\n".join(lines), parse_mode=ParseMode.HTML)
+
+async def _edit_link_list(update: Update, context: ContextTypes.DEFAULT_TYPE, command: str, add_to: Optional[str]):
+    domains = [d for d in (normalize_domain(a) for a in context.args) if d]
+    if not domains:
+        await update.message.reply_text(f"Usage: /{command} <domain> [domain...]")
+        return
+    chat_id = update.effective_chat.id
+    s = await get_chat(chat_id)
+    lists = {"link_allow": s.link_allow.split(), "link_block": s.link_block.split()}
+    for field, items in lists.items():
+        lists[field] = [d for d in items if d not in domains]
+        if field == add_to:
+            lists[field] += domains
+    await set_chat_fields(chat_id, {field: " ".join(items) for field, items in lists.items()})
+    verb = {"link_allow": "allowed", "link_block": "blocked", None: "removed from the link lists"}[add_to]
+    await update.message.reply_text(f"✅ {', '.join(domains)} {verb}.")
+
+@admin_only
+async def cmd_allowlink(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await _edit_link_list(update, context, "allowlink", "link_allow")
+
+@admin_only
+async def cmd_blocklink(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await _edit_link_list(update, context, "blocklink", "link_block")
+
+@admin_only
+async def cmd_unlistlink(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await _edit_link_list(update, context, "unlistlink", None)
+
+@admin_only
+async def cmd_linklists(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    s = await get_chat(update.effective_chat.id)
+    await update.message.reply_text(
+        f"🔗 <b>Link Lists</b>\n\n"
+        f"Always blocked: {', '.join(DEFAULT_LINK_BLOCK)}\n"
+        f"Blocked: {', '.join(s.link_block.split()) or 'none'}\n"
+        f"Allowed: {', '.join(s.link_allow.split()) or 'none'}",
+        parse_mode=ParseMode.HTML,
+    )
+
 @admin_only
 async def cmd_slowmode(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
@@ -283,211 +2566,573 @@ async def cmd_slowmode(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     try:
         sec = int(context.args[0])
-        set_chat_field(update.effective_chat.id, "slow_mode", sec)
+        await set_chat_field(update.effective_chat.id, "slow_mode", sec)
         await update.message.reply_text(f"✅ Slowmode set to {sec} seconds.")
     except Exception:
         await update.message.reply_text("❌ Invalid number.")
 
+@admin_only
+async def cmd_setflood(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    if context.args and context.args[0].lower() == "off":
+        await set_chat_field(chat_id, "flood_limit", 0)
+        await update.message.reply_text("✅ Anti-spam disabled.")
+        return
+    if len(context.args) < 2:
+        await update.message.reply_text("Usage: /setflood <messages> <seconds> [burst] | off")
+        return
+    try:
+        limit, window = int(context.args[0]), int(context.args[1])
+        burst = int(context.args[2]) if len(context.args) > 2 else 0
+        if limit < 1 or window < 1 or burst < 0:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text("❌ Invalid number.")
+        return
+    await set_chat_fields(chat_id, {"flood_limit": limit, "flood_window": window, "flood_burst": burst})
+    await update.message.reply_text(
+        f"✅ Anti-spam: {limit} messages per {window} sec" + (f", bursts of {burst}." if burst else ".")
+    )
+
+@admin_only
+async def cmd_setfloodmute(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    duration = parse_duration(context.args[0]) if context.args else None
+    if not duration:
+        await update.message.reply_text("Usage: /setfloodmute <duration> (e.g. 300, 10m, 1h)")
+        return
+    await set_chat_field(update.effective_chat.id, "flood_mute", duration)
+    await update.message.reply_text(f"✅ Spammers will be muted for {context.args[0]}.")
+
+@admin_only
+async def cmd_addfilter(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = list(context.args)
+    action = "delete"
+    if len(args) > 1 and args[-1].lower() in FILTER_ACTIONS:
+        action = args.pop().lower()
+    phrase = normalize_phrase(" ".join(args))
+    if not phrase:
+        await update.message.reply_text("Usage: /addfilter <word or phrase> [delete|warn|mute]")
+        return
+    if len(phrase) > FILTER_MAX_LEN:
+        await update.message.reply_text(f"❌ Filters are limited to {FILTER_MAX_LEN} characters.")
+        return
+    chat_id = update.effective_chat.id
+    if not await db.run(_q_add_filter, chat_id, phrase, action, FILTER_MAX):
+        await update.message.reply_text(f"❌ This chat already has {FILTER_MAX} filters.")
+        return
+    await set_chat_field(chat_id, "filter_version", time.time_ns())
+    await update.message.reply_text(
+        f"✅ Filter added: <code>{html.escape(phrase)}</code> → {action}", parse_mode=ParseMode.HTML
+    )
+
+@admin_only
+async def cmd_rmfilter(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    phrase = normalize_phrase(" ".join(context.args))
+    if not phrase:
+        await update.message.reply_text("Usage: /rmfilter <word or phrase>")
+        return
+    chat_id = update.effective_chat.id
+    if not await db.run(_q_remove_filter, chat_id, phrase):
+        await update.message.reply_text("❌ No such filter.")
+        return
+    await set_chat_field(chat_id, "filter_version", time.time_ns())
+    await update.message.reply_text(f"✅ Filter removed: <code>{html.escape(phrase)}</code>", parse_mode=ParseMode.HTML)
+
+@admin_only
+async def cmd_filters(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    rows = await db.run(_q_get_filters, update.effective_chat.id)
+    if not rows:
+        await update.message.reply_text("No filters in this chat.")
+        return
+    lines = [f"• <code>{html.escape(p)}</code> → {a}" for p, a in rows]
+    await update.message.reply_text("🧹 <b>Filters</b>\n" + "\n".join(lines), parse_mode=ParseMode.HTML)
+
+@admin_only
+async def cmd_raidmode(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    if context.args and context.args[0].lower() == "off":
+        await set_chat_field(chat_id, "raid_threshold", 0)
+        await update.message.reply_text("✅ Raid detection disabled.")
+        return
+    if len(context.args) < 2:
+        await update.message.reply_text("Usage: /raidmode <joins> <seconds> [lockdown duration] | off")
+        return
+    try:
+        joins, window = int(context.args[0]), int(context.args[1])
+        if joins < 2 or window < 1:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text("❌ Invalid number.")
+        return
+    values = {"raid_threshold": joins, "raid_window": window}
+    if len(context.args) > 2:
+        cooldown = parse_duration(context.args[2])
+        if not cooldown:
+            await update.message.reply_text("❌ Invalid duration.")
+            return
+        values["raid_cooldown"] = cooldown
+    await set_chat_fields(chat_id, values)
+    s = await get_chat(chat_id)
+    await update.message.reply_text(
+        f"✅ Lockdown after {joins} joins within {window} sec, for {format_remaining(s.raid_cooldown)}."
+    )
+
+@admin_only
+async def cmd_lockdown(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat = update.effective_chat
+    if context.args and context.args[0].lower() == "off":
+        await set_chat_field(chat.id, "raid_until", 0)
+        await timed.cancel(chat.id, 0, "unraid")
+        raid.take(chat.id)
+        released = await timed.reschedule(chat.id, "release", int(time.time()))
+        modlog.record(chat.id, "unraid", None, update.effective_user.id)
+        await update.message.reply_text(
+            "✅ Lockdown ended." + (f" Lifting restrictions on {released} held joiners." if released else "")
+        )
+        return
+    s = await get_chat(chat.id)
+    duration = parse_duration(context.args[0]) if context.args else s.raid_cooldown
+    if not duration:
+        await update.message.reply_text("Usage: /lockdown [duration] | off")
+        return
+    await start_lockdown(context, chat, duration, f"started by {update.effective_user.mention_html()}.", update.effective_user.id)
+
 @admin_only
 async def cmd_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    s = get_chat(update.effective_chat.id)
+    s = await get_chat(update.effective_chat.id)
+    flood_txt = "OFF"
+    if s.flood_limit:
+        flood_txt = (
+            f"{s.flood_limit} msgs / {s.flood_window} sec, burst {s.flood_burst or s.flood_limit}, "
+            f"mute {s.flood_mute} sec"
+        )
+    raid_txt = "OFF"
+    if s.raid_threshold:
+        raid_txt = f"{s.raid_threshold} joins / {s.raid_window} sec, lockdown {format_remaining(s.raid_cooldown)}"
+    if s.raid_until > time.time():
+        raid_txt += f" (locked down for {format_remaining(s.raid_until - int(time.time()))})"
     txt = (
         f"⚙️ <b>Group Settings</b>\n\n"
-        f"Rules: {s['rules']}\n"
-        f"Warn limit: {s['warn_limit']}\n"
-        f"Anti-link: {'ON' if s['anti_link'] else 'OFF'}\n"
-        f"Slowmode: {s['slow_mode']} sec\n"
-        f"Welcome: {s['welcome']}\n"
-        f"Goodbye: {s['goodbye']}"
+        f"Rules: {s.rules}\n"
+        f"Warn limit: {s.warn_limit}\n"
+        f"Warn expiry: {f'{s.warn_expiry} sec' if s.warn_expiry else 'never'}\n"
+        f"Anti-link: {'ON' if s.anti_link else 'OFF'}\n"
+        f"Duplicate guard: {'ON' if s.dup_guard else 'OFF'}\n"
+        f"Locks: {', '.join(s.locks.split()) or 'none'}\n"
+        f"Slowmode: {s.slow_mode} sec\n"
+        f"Anti-spam: {flood_txt}\n"
+        f"Raid mode: {raid_txt}\n"
+        f"Welcome: {s.welcome}\n"
+        f"Welcome window: {s.welcome_window} sec, clean welcome {'ON' if s.clean_welcome else 'OFF'}\n"
+        f"Goodbye: {s.goodbye}"
     )
     await update.message.reply_text(txt, parse_mode=ParseMode.HTML)
     # ----------------- Moderation -----------------
 
+async def warn_user(chat: Chat, user: User, s: ChatSettings, by: Optional[int] = None) -> str:
+    # adds a warning, bans at the chat's warn limit and returns the notice to post
+    count = await add_warn(chat.id, user.id, s.warn_expiry)
+    limit = s.warn_limit
+    if count < limit:
+        modlog.record(chat.id, "warn", user.id, by, f"{count}/{limit}")
+        return f"⚠️ {format_user(user)} warned ({count}/{limit})."
+    # through the outbox, which rides out RetryAfter; an admin's /warn waits
+    # for the outcome so failures reach them, automatic warns only queue it
+    ban = outbox.enforce(chat.id, chat.ban_member, user.id)
+    if by is not None:
+        await ban
+    await set_warns(chat.id, user.id, 0)
+    modlog.record(chat.id, "ban", user.id, by, f"warn limit {limit} reached")
+    return f"🚫 {format_user(user)} banned (warn limit {limit} reached)."
+
 @admin_only
 async def cmd_warn(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update.message.reply_to_message:
-        await update.message.reply_text("Reply to a user to warn.")
+    targets, missing = await resolve_targets(update, list(context.args))
+    if not targets and not missing:
+        await update.message.reply_text("Reply to a user, or give @username or ids, to warn.")
         return
-    user = update.message.reply_to_message.from_user
-    chat_id = update.effective_chat.id
-    count = get_warns(chat_id, user.id) + 1
-    set_warns(chat_id, user.id, count)
-
-    limit = get_chat(chat_id)["warn_limit"]
-    if count >= limit:
-        try:
-            await update.effective_chat.ban_member(user.id)
-            set_warns(chat_id, user.id, 0)
-            await update.message.reply_text(
-                f"🚫 {format_user(user)} banned (warn limit {limit} reached).",
-                parse_mode=ParseMode.HTML,
-            )
-        except Exception as e:
-            await update.message.reply_text(f"❌ Could not ban: {e}")
-    else:
-        await update.message.reply_text(
-            f"⚠️ {format_user(user)} warned ({count}/{limit}).",
-            parse_mode=ParseMode.HTML,
-        )
+    s = await get_chat(update.effective_chat.id)
+    await for_each_target(
+        update, targets, missing, "warn",
+        lambda user: warn_user(update.effective_chat, user, s, update.effective_user.id),
+    )
 
 @admin_only
 async def cmd_warnings(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update.message.reply_to_message:
-        await update.message.reply_text("Reply to a user to check warnings.")
+    targets, missing = await resolve_targets(update, list(context.args))
+    if not targets and not missing:
+        await update.message.reply_text("Reply to a user, or give @username or ids, to check warnings.")
         return
-    user = update.message.reply_to_message.from_user
-    count = get_warns(update.effective_chat.id, user.id)
-    await update.message.reply_text(
-        f"⚠️ {format_user(user)} has {count} warnings.",
-        parse_mode=ParseMode.HTML,
-    )
+
+    async def check(user: User) -> str:
+        count = await get_warns(update.effective_chat.id, user.id)
+        return f"⚠️ {format_user(user)} has {count} warnings."
+    await for_each_target(update, targets, missing, "check", check)
 
 @admin_only
 async def cmd_resetwarns(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update.message.reply_to_message:
-        await update.message.reply_text("Reply to a user to reset warnings.")
+    targets, missing = await resolve_targets(update, list(context.args))
+    if not targets and not missing:
+        await update.message.reply_text("Reply to a user, or give @username or ids, to reset warnings.")
         return
-    user = update.message.reply_to_message.from_user
-    set_warns(update.effective_chat.id, user.id, 0)
-    await update.message.reply_text(
-        f"✅ Warnings reset for {format_user(user)}.",
-        parse_mode=ParseMode.HTML,
-    )
+
+    async def reset(user: User) -> str:
+        await set_warns(update.effective_chat.id, user.id, 0)
+        modlog.record(update.effective_chat.id, "resetwarns", user.id, update.effective_user.id)
+        return f"✅ Warnings reset for {format_user(user)}."
+    await for_each_target(update, targets, missing, "reset", reset)
 
 @admin_only
 async def cmd_mute(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update.message.reply_to_message:
-        await update.message.reply_text("Reply to a user to mute.")
+    args = list(context.args)
+    duration_arg = pop_duration(update, args)
+    targets, missing = await resolve_targets(update, args)
+    if not targets and not missing:
+        await update.message.reply_text("Reply to a user, or give @username or ids, to mute: /mute [targets] [duration]")
         return
-    user = update.message.reply_to_message.from_user
-    duration = parse_duration(context.args[0]) if context.args else None
+    chat = update.effective_chat
+    duration = parse_duration(duration_arg)
     until = int(time.time()) + duration if duration else None
-    try:
-        await update.effective_chat.restrict_member(
+
+    async def mute(user: User) -> str:
+        await chat.restrict_member(
             user.id,
             permissions=ChatPermissions(can_send_messages=False),
-            until_date=until,
+            until_date=telegram_until(until),
         )
-        msg = f"🔇 {format_user(user)} muted"
-        if duration:
-            msg += f" for {context.args[0]}"
-        await update.message.reply_text(msg, parse_mode=ParseMode.HTML)
-    except Exception as e:
-        await update.message.reply_text(f"❌ Could not mute: {e}")
+        if until:
+            await timed.schedule(chat.id, user.id, "unmute", until)
+        else:
+            await timed.cancel(chat.id, user.id, "unmute")
+        modlog.record(chat.id, "mute", user.id, update.effective_user.id, duration_arg)
+        return f"🔇 {format_user(user)} muted" + (f" for {duration_arg}." if duration else ".")
+    await for_each_target(update, targets, missing, "mute", mute)
 
 @admin_only
 async def cmd_unmute(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update.message.reply_to_message:
-        await update.message.reply_text("Reply to a user to unmute.")
+    targets, missing = await resolve_targets(update, list(context.args))
+    if not targets and not missing:
+        await update.message.reply_text("Reply to a user, or give @username or ids, to unmute.")
         return
-    user = update.message.reply_to_message.from_user
-    try:
-        await update.effective_chat.restrict_member(
-            user.id, permissions=ChatPermissions(can_send_messages=True)
-        )
-        await update.message.reply_text(
-            f"🔊 {format_user(user)} unmuted.",
-            parse_mode=ParseMode.HTML,
-        )
-    except Exception as e:
-        await update.message.reply_text(f"❌ Could not unmute: {e}")
+    chat = update.effective_chat
+
+    async def unmute(user: User) -> str:
+        await chat.restrict_member(user.id, permissions=ChatPermissions(can_send_messages=True))
+        await timed.cancel(chat.id, user.id, "unmute")
+        modlog.record(chat.id, "unmute", user.id, update.effective_user.id)
+        return f"🔊 {format_user(user)} unmuted."
+    await for_each_target(update, targets, missing, "unmute", unmute)
 
 @admin_only
 async def cmd_ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update.message.reply_to_message:
-        await update.message.reply_text("Reply to a user to ban.")
+    targets, missing = await resolve_targets(update, list(context.args))
+    if not targets and not missing:
+        await update.message.reply_text("Reply to a user, or give @username or ids, to ban.")
         return
-    user = update.message.reply_to_message.from_user
-    try:
-        await update.effective_chat.ban_member(user.id)
+    chat = update.effective_chat
+
+    async def ban(user: User) -> str:
+        await chat.ban_member(user.id)
+        await timed.cancel(chat.id, user.id, "unban")
+        modlog.record(chat.id, "ban", user.id, update.effective_user.id)
+        return f"🚫 {format_user(user)} banned."
+    await for_each_target(update, targets, missing, "ban", ban)
+
+@admin_only
+async def cmd_tempban(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = list(context.args)
+    duration_arg = pop_duration(update, args)
+    duration = parse_duration(duration_arg)
+    targets, missing = await resolve_targets(update, args)
+    if not duration or (not targets and not missing):
         await update.message.reply_text(
-            f"🚫 {format_user(user)} banned.",
-            parse_mode=ParseMode.HTML,
+            "Usage: /tempban [@username|id...] <duration> (e.g. 30m, 2h, 7d), or reply with /tempban <duration>"
         )
-    except Exception as e:
-        await update.message.reply_text(f"❌ Could not ban: {e}")
+        return
+    chat = update.effective_chat
+    until = int(time.time()) + duration
+
+    async def tempban(user: User) -> str:
+        await chat.ban_member(user.id, until_date=telegram_until(until))
+        await timed.schedule(chat.id, user.id, "unban", until)
+        modlog.record(chat.id, "ban", user.id, update.effective_user.id, duration_arg)
+        return f"⏳ {format_user(user)} banned for {duration_arg}."
+    await for_each_target(update, targets, missing, "ban", tempban)
 
 @admin_only
 async def cmd_unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not context.args:
-        await update.message.reply_text("Usage: /unban <user_id>")
+    targets, missing = await resolve_targets(update, list(context.args))
+    if not targets and not missing:
+        await update.message.reply_text("Usage: /unban <@username|user_id> [...]")
         return
+    chat = update.effective_chat
+
+    async def unban(user: User) -> str:
+        await chat.unban_member(user.id)
+        await timed.cancel(chat.id, user.id, "unban")
+        modlog.record(chat.id, "unban", user.id, update.effective_user.id)
+        return f"✅ Unbanned {format_user(user)}."
+    await for_each_target(update, targets, missing, "unban", unban)
+
+@sudo_only
+async def cmd_gban(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = list(context.args)
+    targets, missing = await resolve_targets(update, args)
+    if not targets and not missing:
+        await update.message.reply_text("Usage: reply with /gban [reason] or /gban <@username|user_id> [...] [reason]")
+        return
+    reason = " ".join(args) or None
+
+    async def gban(user: User) -> str:
+        if user.id in SUDO_USERS or user.id == context.bot.id:
+            return f"❌ {format_user(user)} can't be globally banned."
+        await gbans.add(user.id, reason, update.effective_user.id)
+        if update.effective_chat.type != ChatType.PRIVATE:
+            gbans.enforce(context.bot, update.effective_chat.id, user.id)
+        return f"⛔ {format_user(user)} globally banned, applying to every chat."
+    await for_each_target(update, targets, missing, "globally ban", gban)
+
+@sudo_only
+async def cmd_ungban(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    targets, missing = await resolve_targets(update, list(context.args))
+    if not targets and not missing:
+        await update.message.reply_text("Usage: /ungban <@username|user_id> [...]")
+        return
+
+    async def ungban(user: User) -> str:
+        if not await gbans.remove(user.id):
+            return f"❌ {format_user(user)} is not globally banned."
+        return f"✅ {format_user(user)} removed from the global ban list, unbanning everywhere."
+    await for_each_target(update, targets, missing, "globally unban", ungban)
+
+@sudo_only
+async def cmd_gbanexport(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    fd, path = tempfile.mkstemp(suffix=".csv")
+    os.close(fd)
     try:
-        user_id = int(context.args[0])
-        await update.effective_chat.unban_member(user_id)
-        await update.message.reply_text(f"✅ Unbanned <code>{user_id}</code>", parse_mode=ParseMode.HTML)
-    except Exception as e:
-        await update.message.reply_text(f"❌ Could not unban: {e}")
+        count = await gbans.export_file(path)
+        with open(path, "rb") as f:
+            await update.message.reply_document(f, filename="gbans.csv", caption=f"⛔ {count} global bans")
+    finally:
+        os.unlink(path)
+
+@sudo_only
+async def cmd_gbanimport(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    reply = update.message.reply_to_message
+    if not reply or not reply.document:
+        await update.message.reply_text("Reply to a file with one <user_id>[,reason] per line.")
+        return
+    fd, path = tempfile.mkstemp(suffix=".csv")
+    os.close(fd)
+    try:
+        await (await reply.document.get_file()).download_to_drive(path)
+        added = await gbans.import_file(path, update.effective_user.id, SUDO_USERS | {context.bot.id})
+    except TelegramError as e:
+        await update.message.reply_text(f"❌ Could not read the file: {e}")
+        return
+    finally:
+        os.unlink(path)
+    await update.message.reply_text(f"✅ Imported {added} new global bans ({len(gbans)} total).")
 
 @admin_only
 async def cmd_kick(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update.message.reply_to_message:
-        await update.message.reply_text("Reply to a user to kick.")
+    targets, missing = await resolve_targets(update, list(context.args))
+    if not targets and not missing:
+        await update.message.reply_text("Reply to a user, or give @username or ids, to kick.")
         return
-    user = update.message.reply_to_message.from_user
-    try:
-        await update.effective_chat.ban_member(user.id)
-        await update.effective_chat.unban_member(user.id)
-        await update.message.reply_text(
-            f"👢 {format_user(user)} kicked.",
-            parse_mode=ParseMode.HTML,
-        )
-    except Exception as e:
-        await update.message.reply_text(f"❌ Could not kick: {e}")
+    chat = update.effective_chat
+
+    async def kick(user: User) -> str:
+        await chat.ban_member(user.id)
+        await chat.unban_member(user.id)
+        modlog.record(chat.id, "kick", user.id, update.effective_user.id)
+        return f"👢 {format_user(user)} kicked."
+    await for_each_target(update, targets, missing, "kick", kick)
 
 @admin_only
 async def cmd_promote(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update.message.reply_to_message:
-        await update.message.reply_text("Reply to a user to promote.")
+    targets, missing = await resolve_targets(update, list(context.args))
+    if not targets and not missing:
+        await update.message.reply_text("Reply to a user, or give @username or ids, to promote.")
         return
-    user = update.message.reply_to_message.from_user
-    try:
-        await update.effective_chat.promote_member(
+    chat = update.effective_chat
+
+    async def promote(user: User) -> str:
+        await chat.promote_member(
             user.id,
             can_manage_chat=True,
             can_delete_messages=True,
             can_restrict_members=True,
             can_promote_members=False,
         )
-        await update.message.reply_text(
-            f"⬆️ {format_user(user)} promoted to admin.",
-            parse_mode=ParseMode.HTML,
-        )
-    except Exception as e:
-        await update.message.reply_text(f"❌ Could not promote: {e}")
+        admin_cache.set_status(chat.id, user.id, True)
+        return f"⬆️ {format_user(user)} promoted to admin."
+    await for_each_target(update, targets, missing, "promote", promote)
 
 @admin_only
 async def cmd_demote(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update.message.reply_to_message:
-        await update.message.reply_text("Reply to a user to demote.")
+    targets, missing = await resolve_targets(update, list(context.args))
+    if not targets and not missing:
+        await update.message.reply_text("Reply to a user, or give @username or ids, to demote.")
         return
-    user = update.message.reply_to_message.from_user
-    try:
-        await update.effective_chat.promote_member(
+    chat = update.effective_chat
+
+    async def demote(user: User) -> str:
+        await chat.promote_member(
             user.id,
             can_manage_chat=False,
             can_delete_messages=False,
             can_restrict_members=False,
             can_promote_members=False,
         )
-        await update.message.reply_text(
-            f"⬇️ {format_user(user)} demoted.",
-            parse_mode=ParseMode.HTML,
+        admin_cache.set_status(chat.id, user.id, False)
+        return f"⬇️ {format_user(user)} demoted."
+    await for_each_target(update, targets, missing, "demote", demote)
+
+@admin_only
+async def cmd_mutes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    rows = await timed.pending(update.effective_chat.id)
+    if not rows:
+        await update.message.reply_text("No timed mutes, bans or locks.")
+        return
+    now = int(time.time())
+    lines = []
+    for user_id, action, due_at in rows:
+        target = "chat" if action == "unlock" else f"<code>{user_id}</code>"
+        when = "until /unlockchat" if due_at >= TIMED_NEVER else f"in {format_remaining(due_at - now)}"
+        lines.append(f"• {action} {target} {when}")
+    await update.message.reply_text("⏱ <b>Pending</b>\n" + "\n".join(lines), parse_mode=ParseMode.HTML)
+
+@admin_only
+async def cmd_modlog(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /modlog [@username|user_id] [cursor]; replying to someone shows only their entries
+    args = list(context.args)
+    before = MODLOG_TOP
+    if args and ":" in args[-1]:
+        ts, _, row_id = args.pop().partition(":")
+        if not (ts.isdigit() and row_id.isdigit()):
+            args.append("")  # falls through to the usage message
+        else:
+            before = (int(ts), int(row_id))
+    targets, missing = await resolve_targets(update, args)
+    if args or missing or len(targets) > 1:
+        await update.message.reply_text("Usage: /modlog [@username|user_id], or reply to a user with /modlog")
+        return
+    user_id = targets[0].id if targets else None
+    rows = await modlog.page(update.effective_chat.id, user_id, before, MODLOG_PAGE)
+    if not rows:
+        await update.message.reply_text("No older entries." if before != MODLOG_TOP else "No moderation actions logged.")
+        return
+    lines = []
+    for row_id, ts, actor_id, target, action, detail in rows:
+        line = f"• {time.strftime('%Y-%m-%d %H:%M', time.gmtime(ts))} "
+        line += f"<code>{actor_id}</code>" if actor_id else "bot"
+        line += f": {action}"
+        if target:
+            line += f" <code>{target}</code>"
+        if detail:
+            line += f" ({html.escape(detail)})"
+        lines.append(line)
+    text = "📜 <b>Moderation log</b> (UTC)\n" + "\n".join(lines)
+    if len(rows) == MODLOG_PAGE:
+        row_id, ts = rows[-1][:2]
+        text += f"\n\nOlder: <code>/modlog {f'{user_id} ' if user_id else ''}{ts}:{row_id}</code>"
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+
+@admin_only
+async def cmd_lockchat(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    duration = parse_duration(context.args[0]) if context.args else None
+    if context.args and not duration:
+        await update.message.reply_text("Usage: /lockchat [duration] (e.g. 10m, 1h)")
+        return
+    chat = update.effective_chat
+    try:
+        current = (await context.bot.get_chat(chat.id)).permissions
+        until = int(time.time()) + duration if duration else TIMED_NEVER
+        # the unlock row keeps the permissions to restore, also for untimed locks
+        await timed.schedule(chat.id, 0, "unlock", until, current.to_json() if current else None)
+        await chat.set_permissions(ChatPermissions.no_permissions())
+        modlog.record(chat.id, "lockchat", None, update.effective_user.id, context.args[0] if duration else None)
+        msg = "🔒 Chat locked"
+        if duration:
+            msg += f" for {context.args[0]}"
+        await update.message.reply_text(msg + ".")
+    except Exception as e:
+        await update.message.reply_text(f"❌ Could not lock: {e}")
+
+@admin_only
+async def cmd_unlockchat(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat = update.effective_chat
+    try:
+        row = await timed.cancel(chat.id, 0, "unlock")
+        payload = row[0] if row else None
+        await chat.set_permissions(
+            ChatPermissions.de_json(json.loads(payload), context.bot) if payload else UNLOCKED_PERMISSIONS
         )
+        modlog.record(chat.id, "unlock", None, update.effective_user.id)
+        await update.message.reply_text("🔓 Chat unlocked.")
     except Exception as e:
-        await update.message.reply_text(f"❌ Could not demote: {e}")
+        await update.message.reply_text(f"❌ Could not unlock: {e}")
+
+async def purge_range(bot, chat_id: int, start: int, end: int, progress: Optional[Callable] = None) -> Tuple[int, int]:
+    # deleteMessages takes at most PURGE_BATCH ids and skips ones already gone;
+    # batches run PURGE_CONCURRENCY at a time. Returns (deleted, failed) id counts.
+    sem = asyncio.Semaphore(PURGE_CONCURRENCY)
+    done = failed = 0
+
+    async def run(batch: range) -> None:
+        nonlocal done, failed
+        async with sem:
+            while True:
+                try:
+                    await bot.delete_messages(chat_id, list(batch))
+                    done += len(batch)
+                    break
+                except RetryAfter as e:
+                    await asyncio.sleep(e.retry_after)
+                except BadRequest as e:
+                    # e.g. the whole batch is older than 48h
+                    log.info("Purge batch %d-%d in %s failed: %s", batch[0], batch[-1], chat_id, e)
+                    failed += len(batch)
+                    break
+        if progress:
+            await progress(done, failed)
+
+    batches = [range(i, min(i + PURGE_BATCH, end + 1)) for i in range(start, end + 1, PURGE_BATCH)]
+    await asyncio.gather(*(run(b) for b in batches))
+    return done, failed
 
 @admin_only
 async def cmd_purge(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message.reply_to_message:
         await update.message.reply_text("Reply to a message to start purging from.")
         return
+    start = update.message.reply_to_message.message_id
+    end = update.message.message_id
+    total = end - start + 1
+    status = await update.effective_chat.send_message(f"🧹 Purging {total} messages…")
+    last_edit = time.monotonic()
+
+    async def progress(done: int, failed: int) -> None:
+        nonlocal last_edit
+        now = time.monotonic()
+        if now - last_edit < PURGE_PROGRESS_INTERVAL:
+            return
+        last_edit = now
+        try:
+            await status.edit_text(f"🧹 Purging… {done + failed}/{total}")
+        except TelegramError:
+            pass
+
     try:
-        start = update.message.reply_to_message.message_id
-        end = update.message.message_id
-        await context.bot.delete_messages(update.effective_chat.id, list(range(start, end + 1)))
+        done, failed = await purge_range(context.bot, update.effective_chat.id, start, end, progress)
+        modlog.record(update.effective_chat.id, "purge", None, update.effective_user.id, f"{done} messages")
+        msg = f"🧹 Purged {done} messages."
+        if failed:
+            msg += f" {failed} could not be deleted."
+        await status.edit_text(msg)
     except Exception as e:
-        await update.message.reply_text(f"❌ Could not purge: {e}")
+        await status.edit_text(f"❌ Could not purge: {e}")
     # ----------------- Welcome & Goodbye -----------------
 
 @admin_only
@@ -496,112 +3141,616 @@ async def cmd_setwelcome(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not text:
         await update.message.reply_text("Usage: /setwelcome <text>")
         return
-    set_chat_field(update.effective_chat.id, "welcome", text)
+    try:
+        Template(text)
+    except TemplateError as e:
+        await update.message.reply_text(
+            f"❌ Invalid template: {e}\nAvailable placeholders: {TEMPLATE_HELP}"
+        )
+        return
+    await set_chat_field(update.effective_chat.id, "welcome", text)
     await update.message.reply_text("✅ Welcome message updated.")
 
 @admin_only
 async def cmd_resetwelcome(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    set_chat_field(update.effective_chat.id, "welcome", DEFAULT_WELCOME)
+    await set_chat_field(update.effective_chat.id, "welcome", DEFAULT_WELCOME)
     await update.message.reply_text("✅ Welcome message reset.")
 
 @admin_only
 async def cmd_testwelcome(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    s = get_chat(update.effective_chat.id)
-    msg = format_template(s["welcome"], update.effective_user)
+    s = await get_chat(update.effective_chat.id)
+    msg = await render_template(s.welcome, [update.effective_user], update.effective_chat, context.bot)
     await update.message.reply_text(msg, parse_mode=ParseMode.HTML)
 
+@admin_only
+async def cmd_welcomewindow(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args:
+        await update.message.reply_text("Usage: /welcomewindow <seconds>")
+        return
+    try:
+        sec = int(context.args[0])
+        if sec < 0:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text("❌ Invalid number.")
+        return
+    await set_chat_field(update.effective_chat.id, "welcome_window", sec)
+    await update.message.reply_text(f"✅ Joins are now greeted together every {sec} seconds.")
+
+@admin_only
+async def cmd_cleanwelcome(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args or context.args[0].lower() not in ("on", "off"):
+        await update.message.reply_text("Usage: /cleanwelcome on|off")
+        return
+    val = 1 if context.args[0].lower() == "on" else 0
+    await set_chat_field(update.effective_chat.id, "clean_welcome", val)
+    await update.message.reply_text(f"✅ Clean welcome {'enabled' if val else 'disabled'}.")
+
 @admin_only
 async def cmd_setgoodbye(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = " ".join(context.args).strip()
     if not text:
         await update.message.reply_text("Usage: /setgoodbye <text>")
         return
-    set_chat_field(update.effective_chat.id, "goodbye", text)
+    try:
+        Template(text)
+    except TemplateError as e:
+        await update.message.reply_text(
+            f"❌ Invalid template: {e}\nAvailable placeholders: {TEMPLATE_HELP}"
+        )
+        return
+    await set_chat_field(update.effective_chat.id, "goodbye", text)
     await update.message.reply_text("✅ Goodbye message updated.")
 
 @admin_only
 async def cmd_resetgoodbye(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    set_chat_field(update.effective_chat.id, "goodbye", DEFAULT_GOODBYE)
+    await set_chat_field(update.effective_chat.id, "goodbye", DEFAULT_GOODBYE)
     await update.message.reply_text("✅ Goodbye message reset.")
 
 @admin_only
 async def cmd_testgoodbye(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    s = get_chat(update.effective_chat.id)
-    msg = format_template(s["goodbye"], update.effective_user)
+    s = await get_chat(update.effective_chat.id)
+    msg = await render_template(s.goodbye, [update.effective_user], update.effective_chat, context.bot)
     await update.message.reply_text(msg, parse_mode=ParseMode.HTML)
 
+# Joins are collected per chat and greeted with one combined message once the
+# chat's welcome_window has passed, and never more often than
+# WELCOME_MIN_INTERVAL, so an invite wave costs one send instead of hundreds.
+class WelcomeBatcher:
+    def __init__(self, max_mentions: int):
+        self.max_mentions = max_mentions
+        self._pending: Dict[int, List[User]] = {}
+        self._chats: Dict[int, Chat] = {}
+        self._extra: Dict[int, int] = {}  # joins beyond max_mentions
+        self._last_sent: Dict[int, float] = {}
+        self._last_msg: Dict[int, int] = {}  # message id of the previous welcome
+
+    def add(self, chat: Chat, users: List[User]) -> bool:
+        # True when this starts a new batch and a flush must be scheduled
+        chat_id = chat.id
+        first = chat_id not in self._pending
+        self._chats[chat_id] = chat
+        pending = self._pending.setdefault(chat_id, [])
+        room = self.max_mentions - len(pending)
+        pending.extend(users[:room])
+        if len(users) > room:
+            self._extra[chat_id] = self._extra.get(chat_id, 0) + len(users) - room
+        return first
+
+    def delay(self, chat_id: int, window: int, now: float) -> float:
+        since = now - self._last_sent.get(chat_id, float("-inf"))
+        return max(window, WELCOME_MIN_INTERVAL - since)
+
+    def pop(self, chat_id: int) -> Tuple[Optional[Chat], List[User], int]:
+        return self._chats.pop(chat_id, None), self._pending.pop(chat_id, []), self._extra.pop(chat_id, 0)
+
+    def sent(self, chat_id: int, message_id: int, now: float) -> Optional[int]:
+        # records the new welcome and returns the previous one's id
+        self._last_sent[chat_id] = now
+        previous = self._last_msg.get(chat_id)
+        self._last_msg[chat_id] = message_id
+        return previous
+
+welcomes = WelcomeBatcher(WELCOME_MAX_MENTIONS)
+
+async def welcome_flush_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat_id = context.job.chat_id
+    chat, users, extra = welcomes.pop(chat_id)
+    if not users:
+        return
+    s = await get_chat(chat_id)
+    msg = await render_template(s.welcome, users, chat, context.bot, extra)
+    try:
+        sent = await outbox.send(context.bot, chat_id, msg)
+    except TelegramError:
+        return  # already logged by the outbox
+    previous = welcomes.sent(chat_id, sent.message_id, time.monotonic())
+    if s.clean_welcome and previous:
+        outbox.enforce(chat_id, context.bot.delete_message, chat_id, previous)
+
+# Join rate per chat over a sliding window, estimated from two fixed slots
+# (this one and the previous), so each chat costs three numbers however fast
+# it fills. The last `threshold` joiners are remembered so the accounts that
+# set off a lockdown get restricted too, and joiners held during a lockdown
+# are restricted in bulk by raid_restrict_job.
+class _JoinCounter:
+    __slots__ = ("slot", "current", "previous", "last")
+
+    def __init__(self, slot: int, now: float):
+        self.slot = slot
+        self.current = 0
+        self.previous = 0
+        self.last = now
+
+class RaidMonitor:
+    def __init__(self, idle: float):
+        self.idle = idle
+        self._counters: Dict[int, _JoinCounter] = {}
+        self._recent: Dict[int, deque] = {}  # chat_id -> latest joiner ids
+        self._held: Dict[int, Set[int]] = {}  # chat_id -> joiners waiting to be restricted
+        self.lockdowns = 0
+
+    def joined(self, chat_id: int, user_ids: List[int], now: float, threshold: int, window: int) -> bool:
+        # records the joins; True when the rate reached threshold per window
+        slot = int(now // window)
+        c = self._counters.get(chat_id)
+        if c is None:
+            c = self._counters[chat_id] = _JoinCounter(slot, now)
+        elif slot != c.slot:
+            c.previous = c.current if slot == c.slot + 1 else 0
+            c.current = 0
+            c.slot = slot
+        c.current += len(user_ids)
+        c.last = now
+        recent = self._recent.get(chat_id)
+        if recent is None or recent.maxlen != threshold:
+            recent = self._recent[chat_id] = deque(recent or (), maxlen=threshold)
+        recent.extend(user_ids)
+        return c.current + c.previous * (1 - (now % window) / window) >= threshold
+
+    def rate(self, chat_id: int) -> int:
+        c = self._counters.get(chat_id)
+        return c.current + c.previous if c else 0
+
+    def recent(self, chat_id: int) -> List[int]:
+        return list(self._recent.pop(chat_id, ()))
+
+    def hold(self, chat_id: int, user_ids: List[int]) -> bool:
+        # True when this starts a new batch and a restrict job must be scheduled
+        first = chat_id not in self._held
+        self._held.setdefault(chat_id, set()).update(user_ids)
+        return first
+
+    def take(self, chat_id: int) -> Set[int]:
+        return self._held.pop(chat_id, set())
+
+    def sweep(self, now: float) -> int:
+        idle = [chat_id for chat_id, c in self._counters.items() if now - c.last > self.idle]
+        for chat_id in idle:
+            del self._counters[chat_id]
+            self._recent.pop(chat_id, None)
+        return len(idle)
+
+    def stats(self) -> Dict[str, int]:
+        return {"chats": len(self._counters), "held": sum(map(len, self._held.values())), "lockdowns": self.lockdowns}
+
+raid = RaidMonitor(RAID_IDLE)
+
+async def raid_sweep_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    raid.sweep(time.time())
+
+async def raid_restrict_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat_id = context.job.chat_id
+    user_ids = raid.take(chat_id)
+    s = await get_chat(chat_id)
+    if s.raid_until <= time.time():
+        return  # lifted before this batch came up
+    # until_date is only a backstop: the release rows lift the restriction,
+    # also when /lockdown off ends it early
+    until = telegram_until(max(s.raid_until, int(time.time()) + 31))
+    for user_id in user_ids:
+        outbox.enforce(
+            chat_id, context.bot.restrict_chat_member, chat_id, user_id, ChatPermissions.no_permissions(),
+            until_date=until,
+        )
+    await timed.schedule_many(chat_id, user_ids, "release", s.raid_until)
+
+async def start_lockdown(
+    context: ContextTypes.DEFAULT_TYPE, chat: Chat, duration: int, reason: str, by: Optional[int] = None
+) -> int:
+    until = int(time.time()) + duration
+    await set_chat_field(chat.id, "raid_until", until)
+    await timed.schedule(chat.id, 0, "unraid", until)
+    await timed.reschedule(chat.id, "release", until)  # joiners held so far stay held until the new end
+    modlog.record(chat.id, "lockdown", None, by, format_remaining(duration))
+    welcomes.pop(chat.id)  # nobody from the wave gets greeted
+    if raid.hold(chat.id, raid.recent(chat.id)):
+        context.job_queue.run_once(raid_restrict_job, RAID_RESTRICT_DELAY, chat_id=chat.id)
+    raid.lockdowns += 1
+    admins = await admin_cache.get(context.bot, chat.id)
+    # invisible mentions notify the admins without cluttering the alert
+    tags = "".join(f'<a href="tg://user?id={a}">\u200b</a>' for a in admins)
+    outbox.send(
+        context.bot,
+        chat.id,
+        f"🚨 <b>Lockdown</b>: {reason}\n"
+        f"New members are muted and welcomes are off for {format_remaining(duration)}. "
+        f"/lockdown off ends it early.{tags}",
+    )
+    return until
+
 async def welcome_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.new_chat_members:
-        s = get_chat(update.effective_chat.id)
-        for u in update.message.new_chat_members:
-            msg = format_template(s["welcome"], u)
-            await update.message.reply_text(msg, parse_mode=ParseMode.HTML)
+        chat_id = update.effective_chat.id
+        members = update.message.new_chat_members
+        for u in members:
+            seen_users.seen(u)
+        if gbans and any(u.id in gbans for u in members):
+            for u in members:
+                if u.id in gbans:
+                    gbans.enforce(context.bot, chat_id, u.id)
+                    outbox.notice(context.bot, chat_id, "⛔ Removed globally banned {}.", u.mention_html())
+            members = [u for u in members if u.id not in gbans]
+            if not members:
+                return
+        s = await get_chat(chat_id)
+        if s.raid_threshold or s.raid_until:
+            now = time.time()
+            until = s.raid_until
+            joiners = [u.id for u in members if u.id != context.bot.id]
+            if s.raid_threshold and raid.joined(chat_id, joiners, now, s.raid_threshold, s.raid_window):
+                if until <= now:
+                    reason = f"{raid.rate(chat_id)} joins within {s.raid_window} sec."
+                    until = await start_lockdown(context, update.effective_chat, s.raid_cooldown, reason)
+            if until > now:
+                if raid.hold(chat_id, joiners):
+                    context.job_queue.run_once(raid_restrict_job, RAID_RESTRICT_DELAY, chat_id=chat_id)
+                return
+        if welcomes.add(update.effective_chat, members):
+            delay = welcomes.delay(chat_id, s.welcome_window, time.monotonic())
+            context.job_queue.run_once(welcome_flush_job, delay, chat_id=chat_id)
     elif update.message.left_chat_member:
-        s = get_chat(update.effective_chat.id)
+        s = await get_chat(update.effective_chat.id)
         u = update.message.left_chat_member
-        msg = format_template(s["goodbye"], u)
+        seen_users.seen(u)
+        msg = await render_template(s.goodbye, [u], update.effective_chat, context.bot)
         await update.message.reply_text(msg, parse_mode=ParseMode.HTML)
+
+async def member_update_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    cmu = update.chat_member or update.my_chat_member
+    new = cmu.new_chat_member
+    if update.my_chat_member:
+        # while the bot is not an admin it gets no chat_member updates, so
+        # whatever roster it had goes stale; load a fresh one when next needed
+        admin_cache.invalidate(cmu.chat.id)
+        return
+    admin_cache.set_status(cmu.chat.id, new.user.id, new.status in (ChatMember.ADMINISTRATOR, ChatMember.OWNER))
         # ----------------- Protections -----------------
 
-async def protect_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+pending_mutes: Dict[Tuple[int, int], asyncio.Future] = {}  # (chat_id, user_id) -> queued or running restrict
+
+async def auto_mute(update: Update, context: ContextTypes.DEFAULT_TYPE, seconds: int, template: str, reason: str) -> None:
+    # queues the delete, the mute and a merged notice, and records the unmute;
+    # the rest of a burst only gets deleted while its mute is still pending
+    chat_id = update.effective_chat.id
+    user = update.effective_user
+    outbox.enforce(chat_id, update.message.delete)
+    key = (chat_id, user.id)
+    if key in pending_mutes:
+        return
+    until = int(time.time()) + seconds
+    mute = outbox.enforce(
+        chat_id, context.bot.restrict_chat_member, chat_id, user.id,
+        ChatPermissions(can_send_messages=False), until_date=telegram_until(until),
+    )
+    pending_mutes[key] = mute
+    mute.add_done_callback(lambda _: pending_mutes.pop(key, None))
+    outbox.notice(context.bot, chat_id, template, user.mention_html())
+    modlog.record(chat_id, "mute", user.id, detail=f"{reason}, {format_remaining(seconds)}")
+    await timed.schedule(chat_id, user.id, "unmute", until)
+
+# Pipeline stages: each gets the update and the chat's settings and returns
+# True when it acted on the message.
+async def stage_gban(update: Update, context: ContextTypes.DEFAULT_TYPE, s: Optional[ChatSettings]) -> bool:
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
-    s = get_chat(chat_id)
+    if user_id not in gbans:
+        return False
+    outbox.enforce(chat_id, update.message.delete)
+    gbans.enforce(context.bot, chat_id, user_id)
+    return True
+
+async def stage_locks(update: Update, context: ContextTypes.DEFAULT_TYPE, s: ChatSettings) -> bool:
+    message = update.message
+    locked = next((t for t, check in lock_checks(s.locks) if check(message)), None)
+    if locked is None:
+        return False
+    if await admin_cache.is_admin(context.bot, message.chat_id, update.effective_user.id):
+        return False
+    outbox.enforce(message.chat_id, message.delete)
+    modlog.record(message.chat_id, "delete", update.effective_user.id, detail=f"{locked} locked")
+    return True
+
+async def stage_link(update: Update, context: ContextTypes.DEFAULT_TYPE, s: ChatSettings) -> bool:
+    if not has_blocked_link(update.message, s):
+        return False
+    await auto_mute(update, context, 60, "🚫 {} muted for sending links.", "link")
+    return True
+
+async def stage_duplicates(update: Update, context: ContextTypes.DEFAULT_TYPE, s: ChatSettings) -> bool:
+    message = update.message
+    text = message.text or message.caption
+    if not text:
+        return False
+    hits = duplicates.check(message.chat_id, update.effective_user.id, message.message_id, text, time.monotonic())
+    if not hits:
+        return False
+    await remove_duplicates(context.bot, hits)
+    return True
+
+async def stage_filters(update: Update, context: ContextTypes.DEFAULT_TYPE, s: ChatSettings) -> bool:
+    hit = await match_filters(update.message, s)
+    if not hit:
+        return False
+    chat_id = update.effective_chat.id
+    phrase, action = hit
+    if action == "mute":
+        await auto_mute(update, context, FILTER_MUTE, "🔇 {} muted for using a filtered phrase.", f"filter: {phrase}")
+        return True
+    outbox.enforce(chat_id, update.message.delete)
+    modlog.record(chat_id, "delete", update.effective_user.id, detail=f"filter: {phrase}")
+    if action == "warn":
+        try:
+            msg = await warn_user(update.effective_chat, update.effective_user, s)
+        except TelegramError as e:
+            log.info("Filter warn for %s in %s failed: %s", update.effective_user.id, chat_id, e)
+            return True
+        outbox.send(context.bot, chat_id, msg)
+    return True
+
+async def stage_flood(update: Update, context: ContextTypes.DEFAULT_TYPE, s: ChatSettings) -> bool:
+    verdict = await state.check_flood(update.effective_chat.id, update.effective_user.id, s)
+    if verdict == FLOOD_SLOW:
+        outbox.enforce(update.effective_chat.id, update.message.delete)
+    elif verdict == FLOOD_SPAM:
+        await auto_mute(update, context, s.flood_mute, "🤖 {} auto-muted for spamming.", "flood")
+    else:
+        return False
+    return True
+
+# Runs the stages in cost order and stops at the first one that acts. The
+# `pre` stages need no settings and run before the chat is even looked up; the
+# rest are filtered per chat by their enabled(s) test. That filtered list, the
+# chat's plan, is kept on its ChatSettings until a setting changes.
+class ModerationPipeline:
+    def __init__(self, pre: List[Tuple[str, Callable]], stages: List[Tuple[str, Callable, Callable]]):
+        self.pre = pre
+        self.stages = stages
+        self._stats = {name: [0, 0, 0.0] for name, *_ in pre + stages}  # name -> [runs, actions, seconds]
+        self._labels = {name: (("stage", name),) for name in self._stats}
+        self.plans_built = 0
+
+    def plan(self, s: ChatSettings) -> Tuple[Tuple[str, Callable], ...]:
+        plan = s.plan
+        if plan is None:
+            plan = s.plan = tuple((name, check) for name, check, enabled in self.stages if enabled(s))
+            self.plans_built += 1
+        return plan
+
+    async def _run_stage(self, name: str, check: Callable, update: Update, context, s) -> bool:
+        t0 = time.perf_counter()
+        acted = await check(update, context, s)
+        elapsed = time.perf_counter() - t0
+        stat = self._stats[name]
+        stat[0] += 1
+        stat[1] += acted
+        stat[2] += elapsed
+        if metrics.enabled:
+            metrics.observe("ff_stage_seconds", self._labels[name], elapsed)
+        return acted
+
+    async def run(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[str]:
+        # the name of the stage that acted, if any
+        for name, check in self.pre:
+            if await self._run_stage(name, check, update, context, None):
+                return name
+        s = await get_chat(update.effective_chat.id)
+        for name, check in self.plan(s):
+            if await self._run_stage(name, check, update, context, s):
+                return name
+        return None
 
-    # --- Anti-link ---
-    if s["anti_link"]:
-        text = update.message.text or ""
-        if "t.me/" in text or "telegram.me/" in text:
-            try:
-                await update.message.delete()
-                await update.effective_chat.restrict_member(
-                    user_id, permissions=ChatPermissions(can_send_messages=False), until_date=int(time.time()) + 60
-                )
-                await update.effective_chat.send_message(
-                    f"🚫 {update.effective_user.mention_html()} muted for sending links.",
-                    parse_mode=ParseMode.HTML,
-                )
-                return
-            except Exception:
-                pass
-
-    # --- Slowmode ---
-    if s["slow_mode"] > 0:
-        key = (chat_id, user_id)
-        last = _msg_times.get(key, [0])[-1]
-        now = time.time()
-        if now - last < s["slow_mode"]:
-            try:
-                await update.message.delete()
-            except Exception:
-                pass
-            return
-        _msg_times.setdefault(key, []).append(now)
-
-    # --- Spam Check ---
-    key = (chat_id, user_id)
-    now = time.time()
-    history = _msg_times.get(key, [])
-    history = [t for t in history if now - t < SPAM_WINDOW]
-    history.append(now)
-    _msg_times[key] = history
-    if len(history) > SPAM_THRESHOLD:
+    def stats(self) -> Dict[str, Tuple[int, int, float]]:
+        # name -> (runs, actions, mean µs per run)
+        return {name: (n, acted, secs / n * 1e6 if n else 0.0) for name, (n, acted, secs) in self._stats.items()}
+
+pipeline = ModerationPipeline(
+    pre=[("gban", stage_gban)],
+    stages=[
+        ("locks", stage_locks, lambda s: bool(s.locks)),
+        ("link", stage_link, lambda s: s.anti_link),
+        ("duplicates", stage_duplicates, lambda s: s.dup_guard),
+        ("filters", stage_filters, lambda s: s.filter_version > 0),  # may load the chat's filters
+        # always on: the redis backend also checks the chat's settings version here
+        ("flood", stage_flood, lambda s: True),
+    ],
+)
+
+async def protect_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    seen_users.seen(update.effective_user)
+    await pipeline.run(update, context)
+
+            # ----------------- Main -----------------
+
+async def on_startup(app) -> None:
+    await state.start()
+    await gbans.load()
+    if metrics.enabled:
+        HTTPServer(WebApplication([(r"/metrics", MetricsHandler)])).listen(METRICS_PORT, METRICS_LISTEN)
+        log.info("📈 Metrics on http://%s:%s/metrics", METRICS_LISTEN, METRICS_PORT)
+
+async def on_stop(app) -> None:
+    await outbox.close(OUTBOX_DRAIN_TIMEOUT)  # the bot still has its connection here
+
+async def on_shutdown(app) -> None:
+    await state.close()
+    modlog.flush()
+    seen_users.flush()
+    db.close()  # commits anything still queued by write-behind
+
+# ----------------- Update scheduling -----------------
+# Runs updates from different chats in parallel while keeping each chat
+# strictly ordered (flood counting and warn increments depend on it). The
+# first update of an idle chat takes one of max_concurrent_updates slots and
+# then also drains whatever that chat queues behind it; queued updates hold no
+# slot, so a slow chat never starves the others.
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._queues: Dict[int, deque] = {}  # chat_id -> coroutines waiting behind the running one
+        self.queued = 0
+        self.max_queued = 0
+        self.processed = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def _run(self, coroutine) -> None:
         try:
-            await update.message.delete()
-            await update.effective_chat.restrict_member(
-                user_id, permissions=ChatPermissions(can_send_messages=False), until_date=int(time.time()) + 300
-            )
-            await update.effective_chat.send_message(
-                f"🤖 {update.effective_user.mention_html()} auto-muted for spamming.",
-                parse_mode=ParseMode.HTML,
-            )
+            await coroutine
         except Exception:
-            pass
-            # ----------------- Main -----------------
+            log.exception("Update processing failed")
+        self.processed += 1
 
-def main():
-    init_db()
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    async def do_process_update(self, update: object, coroutine) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await self._run(coroutine)
+            return
+        queue = self._queues.get(chat.id)
+        if queue is not None:
+            queue.append(coroutine)
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+            return
+        queue = self._queues[chat.id] = deque()
+        try:
+            await self._run(coroutine)
+            while queue:
+                self.queued -= 1
+                await self._run(queue.popleft())
+        finally:
+            del self._queues[chat.id]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "active_chats": len(self._queues),
+            "max_concurrent": self.max_concurrent_updates,
+            "queued": self.queued,
+            "max_queued": self.max_queued,
+            "processed": self.processed,
+        }
+
+update_processor = ChatOrderedUpdateProcessor(CONCURRENT_UPDATES)
+
+# ----------------- Webhook -----------------
+# Embedded tornado listener used instead of long polling: POST /<WEBHOOK_PATH>
+# feeds Telegram updates into the application, GET /healthz is for load
+# balancers. Recorded Update JSON can be POSTed by hand for local testing.
+class WebhookHandler(RequestHandler):
+    def initialize(self, app) -> None:
+        self.app = app
+
+    async def post(self) -> None:
+        if WEBHOOK_SECRET:
+            token = self.request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if not hmac.compare_digest(token, WEBHOOK_SECRET):
+                self.set_status(403)
+                return
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.app.bot)
+        except Exception as e:
+            log.info("Rejected webhook payload: %s", e)
+            self.set_status(400)
+            return
+        await self.app.update_queue.put(update)
+
+class HealthHandler(RequestHandler):
+    def initialize(self, app) -> None:
+        self.app = app
+
+    def get(self) -> None:
+        if not self.app.running:
+            self.set_status(503)
+        self.write({"status": "ok" if self.app.running else "stopped", "pending_updates": self.app.update_queue.qsize()})
+
+async def serve_webhook(app) -> None:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    web = WebApplication([
+        (rf"/{WEBHOOK_PATH}", WebhookHandler, {"app": app}),
+        (r"/healthz", HealthHandler, {"app": app}),
+    ])
+    server = HTTPServer(web)
+    server.listen(WEBHOOK_PORT, WEBHOOK_LISTEN)
+    if WEBHOOK_URL:
+        await app.bot.set_webhook(
+            f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    log.info("✅ Webhook listening on %s:%s/%s", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+    try:
+        await stop.wait()
+    finally:
+        server.stop()
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+metrics.gauge("ff_settings_cache_entries", "Chats in the settings cache.", lambda: settings_cache.stats()["size"])
+metrics.gauge("ff_settings_cache_hits_total", "Settings cache hits.", lambda: settings_cache.hits, "counter")
+metrics.gauge("ff_settings_cache_misses_total", "Settings cache misses.", lambda: settings_cache.misses, "counter")
+metrics.gauge("ff_admin_cache_chats", "Chats with a cached admin roster.", lambda: admin_cache.stats()["chats"])
+metrics.gauge("ff_flood_keys", "Tracked (chat, user) flood buckets.", lambda: len(flood))
+metrics.gauge("ff_welcome_pending_chats", "Chats with a welcome batch waiting.", lambda: len(welcomes._pending))
+metrics.gauge("ff_update_active_chats", "Chats with an update being processed.", lambda: update_processor.stats()["active_chats"])
+metrics.gauge("ff_db_pending_writes", "Writes queued by write-behind.", lambda: len(db._pending))
+metrics.gauge("ff_timed_actions_loaded", "Timed actions held in memory.", lambda: len(timed._live))
+metrics.gauge("ff_duplicate_keys", "Message fingerprints tracked across chats.", lambda: len(duplicates))
+metrics.gauge("ff_seen_users", "User profiles cached for @username/id lookups.", lambda: len(seen_users))
+metrics.gauge("ff_gban_users", "Users on the global ban list.", lambda: len(gbans))
+metrics.gauge("ff_outbox_queued", "Bot API calls waiting in the outbox.", lambda: len(outbox))
+metrics.gauge("ff_update_queued", "Updates waiting behind their chat.", lambda: update_processor.queued)
+
+def build_app(builder: Optional[ApplicationBuilder] = None):
+    # bench.py passes a builder wired to a fake Bot API transport
+    if builder is None:
+        builder = ApplicationBuilder().token(BOT_TOKEN)
+        if metrics.enabled:
+            builder = builder.request(MetricsRequest(connection_pool_size=256))
+    app = (
+        builder
+        .concurrent_updates(update_processor)
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     # Core
     app.add_handler(CommandHandler("start", cmd_start))
@@ -612,13 +3761,32 @@ def main():
     app.add_handler(CommandHandler("id", cmd_id))
     app.add_handler(CommandHandler("userinfo", cmd_userinfo))
     app.add_handler(CommandHandler("echo", cmd_echo))
+    app.add_handler(CommandHandler("botstats", cmd_botstats))
 
     # Group settings
+    app.add_handler(CommandHandler("lockchat", cmd_lockchat))
+    app.add_handler(CommandHandler("unlockchat", cmd_unlockchat))
     app.add_handler(CommandHandler("rules", cmd_rules))
     app.add_handler(CommandHandler("setrules", cmd_setrules))
     app.add_handler(CommandHandler("setwarnlimit", cmd_setwarnlimit))
+    app.add_handler(CommandHandler("setwarnexpiry", cmd_setwarnexpiry))
     app.add_handler(CommandHandler("antilink", cmd_antilink))
+    app.add_handler(CommandHandler("dupguard", cmd_dupguard))
+    app.add_handler(CommandHandler("lock", cmd_lock))
+    app.add_handler(CommandHandler("unlock", cmd_unlock))
+    app.add_handler(CommandHandler("locks", cmd_locks))
+    app.add_handler(CommandHandler("allowlink", cmd_allowlink))
+    app.add_handler(CommandHandler("blocklink", cmd_blocklink))
+    app.add_handler(CommandHandler("unlistlink", cmd_unlistlink))
+    app.add_handler(CommandHandler("linklists", cmd_linklists))
     app.add_handler(CommandHandler("slowmode", cmd_slowmode))
+    app.add_handler(CommandHandler("setflood", cmd_setflood))
+    app.add_handler(CommandHandler("setfloodmute", cmd_setfloodmute))
+    app.add_handler(CommandHandler("addfilter", cmd_addfilter))
+    app.add_handler(CommandHandler("rmfilter", cmd_rmfilter))
+    app.add_handler(CommandHandler("filters", cmd_filters))
+    app.add_handler(CommandHandler("raidmode", cmd_raidmode))
+    app.add_handler(CommandHandler("lockdown", cmd_lockdown))
     app.add_handler(CommandHandler("settings", cmd_settings))
 
     # Moderation
@@ -628,8 +3796,15 @@ def main():
     app.add_handler(CommandHandler("mute", cmd_mute))
     app.add_handler(CommandHandler("unmute", cmd_unmute))
     app.add_handler(CommandHandler("ban", cmd_ban))
+    app.add_handler(CommandHandler("tempban", cmd_tempban))
     app.add_handler(CommandHandler("unban", cmd_unban))
+    app.add_handler(CommandHandler("mutes", cmd_mutes))
+    app.add_handler(CommandHandler("modlog", cmd_modlog))
     app.add_handler(CommandHandler("kick", cmd_kick))
+    app.add_handler(CommandHandler("gban", cmd_gban))
+    app.add_handler(CommandHandler("ungban", cmd_ungban))
+    app.add_handler(CommandHandler("gbanexport", cmd_gbanexport))
+    app.add_handler(CommandHandler("gbanimport", cmd_gbanimport))
     app.add_handler(CommandHandler("promote", cmd_promote))
     app.add_handler(CommandHandler("demote", cmd_demote))
     app.add_handler(CommandHandler("purge", cmd_purge))
@@ -638,16 +3813,51 @@ def main():
     app.add_handler(CommandHandler("setwelcome", cmd_setwelcome))
     app.add_handler(CommandHandler("resetwelcome", cmd_resetwelcome))
     app.add_handler(CommandHandler("testwelcome", cmd_testwelcome))
+    app.add_handler(CommandHandler("welcomewindow", cmd_welcomewindow))
+    app.add_handler(CommandHandler("cleanwelcome", cmd_cleanwelcome))
     app.add_handler(CommandHandler("setgoodbye", cmd_setgoodbye))
     app.add_handler(CommandHandler("resetgoodbye", cmd_resetgoodbye))
     app.add_handler(CommandHandler("testgoodbye", cmd_testgoodbye))
     app.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS | filters.StatusUpdate.LEFT_CHAT_MEMBER, welcome_handler))
+    app.add_handler(ChatMemberHandler(member_update_handler, ChatMemberHandler.ANY_CHAT_MEMBER))
 
     # Protections
-    app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), protect_handler))
+    app.add_handler(MessageHandler(
+        filters.UpdateType.MESSAGE & ~filters.COMMAND & ~filters.StatusUpdate.ALL, protect_handler
+    ))
+
+    if metrics.enabled:
+        for handlers in app.handlers.values():
+            for handler in handlers:
+                handler.callback = instrument(handler.callback)
+
+    # Jobs
+    app.job_queue.run_repeating(flood_sweep_job, interval=FLOOD_SWEEP_INTERVAL)
+    app.job_queue.run_repeating(warn_sweep_job, interval=WARN_SWEEP_INTERVAL, first=60)
+    app.job_queue.run_repeating(timed_actions_job, interval=TIMED_TICK)
+    app.job_queue.run_repeating(raid_sweep_job, interval=RAID_IDLE)
+    app.job_queue.run_repeating(gban_fanout_job, interval=GBAN_FANOUT_INTERVAL)
+    app.job_queue.run_repeating(modlog_flush_job, interval=MODLOG_FLUSH)
+    app.job_queue.run_repeating(users_flush_job, interval=USERS_FLUSH)
+    if MODLOG_RETENTION:
+        app.job_queue.run_repeating(modlog_prune_job, interval=MODLOG_PRUNE_INTERVAL, first=120)
+    if db.write_behind:
+        app.job_queue.run_repeating(write_behind_job, interval=WRITE_BEHIND_MS / 1000)
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description="Rose-like group manager bot")
+    parser.add_argument("--mode", choices=("polling", "webhook"), default=os.getenv("BOT_MODE", "polling"))
+    args = parser.parse_args()
 
-    log.info("✅ Bot started")
-    app.run_polling()
+    init_db()
+    app = build_app()
+    log.info("✅ Bot started (%s)", args.mode)
+    if args.mode == "webhook":
+        asyncio.run(serve_webhook(app))
+    else:
+        # chat_member updates are opt-in; the admin cache depends on them
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
     main()